@@ -22,71 +22,1154 @@ file and metadata storage.
 
 """
 
+from collections import namedtuple
+import contextlib
 import hashlib
+import io
+import logging
 import os
 import sqlite3
+import stat
 import tempfile
+import threading
+import time
+
+from dbooru.bloom import BloomFilter
+from dbooru.cache import LRUCache
+from dbooru.cache import MappingCache
+from dbooru.chunks import ChunkStore
+from dbooru.chunks import MANIFEST_SUFFIX
+from dbooru.journal import Journal
+from dbooru.snapshot import IndexSnapshot
+from dbooru.snapshot import SnapshotError
+from dbooru.snapshot import write_snapshot
+from dbooru.stats import Stats
+
+_LOGGER = logging.getLogger(__name__)
+
+_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+# new_fids maps fids recorded since the snapshot was written to their ino
+# column values.  keys_current is whether no keys were added since.  version
+# is the backend's version when the snapshot was opened.
+_OpenSnapshot = namedtuple(
+    '_OpenSnapshot', ['snapshot', 'new_fids', 'keys_current', 'version'])
+_HASH_CHUNK_LENGTH = 2 ** 20  # 1 MiB
 
 
 class DbooruBackend:
 
-    """Backend responsible for all interaction with files and metadata."""
+    """Backend responsible for all interaction with files and metadata.
+
+    The backend keeps one persistent database connection per thread, created
+    on first use.  Connections use WAL journaling, so readers don't block the
+    writer and commits don't need to rewrite the main database file.  Use
+    transaction() to group several operations into one commit.
+
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    # Seconds to cache the storage layout; see layout().
+    LAYOUT_TTL = 1
+    # Number of most frequent keys to count co-occurrences of; see
+    # refresh_tag_pairs().
+    DEFAULT_TAG_PAIRS = 100
+    # Seconds between checks for files and keys added by other processes;
+    # see may_have_file().
+    FILTER_TTL = 1
 
-    def __init__(self, root):
+    def __init__(self, root, synchronous='NORMAL', mmap_size=2 ** 28,
+                 cached_statements=256, attr_cache_size=65536,
+                 busy_timeout=30, journal_max_pending=1000,
+                 journal_max_delay=1.0, map_cache_size=256,
+                 chunk_cache_size=64):
         """
         Args:
             root: Path to dbooru directory.
+            synchronous: SQLite synchronous setting.  NORMAL is safe with WAL
+                journaling; only the most recent commits can be lost on power
+                failure.
+            mmap_size: Number of bytes of the database to memory map.
+            cached_statements: Number of prepared statements to cache per
+                connection.
+            attr_cache_size: Number of entries in attr_cache.
+            busy_timeout: Seconds to wait for other connections to release
+                the database lock.
+            journal_max_pending: Number of buffered metadata changes that
+                triggers a commit.
+            journal_max_delay: Maximum seconds to buffer a metadata change.
+                0 commits every change immediately.
+            map_cache_size: Number of unused stored file mappings kept open
+                in map_cache.
+            chunk_cache_size: Number of chunks of chunked files cached in
+                memory.
 
         """
+        synchronous = synchronous.upper()
+        if synchronous not in _SYNCHRONOUS_MODES:
+            raise ValueError('Invalid synchronous setting {!r}'.format(
+                synchronous))
         self.root = root
+        self.synchronous = synchronous
+        self.mmap_size = int(mmap_size)
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+        # Incremented whenever files or attributes are modified.
+        self.version = 0
+        # Cache of data derived from stored files, keyed by fid.  Stored files
+        # are immutable, so entries are only invalidated when a fid is deleted
+        # or stored again.
+        self.attr_cache = LRUCache(attr_cache_size)
+        self._inode_cache = LRUCache(attr_cache_size)
+        # Shared memory mappings of stored files, keyed by fid.
+        self.map_cache = MappingCache(map_cache_size)
+        self._generation = None
+        # (fanout, old fanout or None, time read); see layout().
+        self._layout = None
+        # (threshold, time read); see chunk_threshold.
+        self._chunk_threshold = None
+        self.chunk_store = ChunkStore(self.chunks_dir, self.staging_dir,
+                                      cache_size=chunk_cache_size)
+        # Bloom filters of recorded fids and attribute keys, built on first
+        # use, or None until built; see may_have_file().
+        self._fid_filter = None
+        self._key_filter = None
+        # Files sequence and key serial the filters are current for.
+        self._fid_seq = None
+        self._key_serial = None
+        # (version, time) the filters were last checked for changes.
+        self._filter_checked = None
+        # Names of the filters for the builder thread to build.
+        self._filter_requests = set()
+        self._filter_builder = None
+        self._filter_stop = False
+        self._filter_lock = threading.Lock()
+        self._filter_cond = threading.Condition(self._filter_lock)
+        # _OpenSnapshot used until the filters are built; see
+        # open_snapshot().
+        self._snapshot = None
+        # Latencies of database operations.
+        self.stats = Stats()
+        # Buffers metadata changes; see dbooru.journal.
+        self.journal = Journal(self, max_pending=journal_max_pending,
+                               max_delay=journal_max_delay)
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+    def changed(self):
+        """Record that the files or attributes tables were modified.
+
+        Called by all backend methods that modify metadata.  Code that
+        modifies the tables directly must call it, so that cached query
+        results are invalidated.
+
+        """
+        self.version += 1
 
     @property
     def files_dir(self):
         return os.path.join(self.root, 'files')
 
+    @property
+    def staging_dir(self):
+        """Directory for files being written.
+
+        This is kept inside the dbooru directory so that finished files can be
+        moved into storage with an atomic rename.
+
+        """
+        return os.path.join(self.root, 'staging')
+
+    @property
+    def chunks_dir(self):
+        return os.path.join(self.root, 'chunks')
+
     @property
     def db_file(self):
         return os.path.join(self.root, 'dbooru.db')
 
+    def layout(self):
+        """Return the storage layout as a tuple (fanout, old_fanout).
+
+        Stored files are kept in fanout levels of subdirectories of files_dir,
+        named after successive pairs of hex digits of the fid, so with a
+        fanout of 2 the file abcdef... is stored as files/ab/cd/abcdef....
+        This keeps directories small enough for the file system to handle
+        efficiently.
+
+        old_fanout is the previous fanout while stored files are being moved
+        to a new layout, else None.  The layout is reread from the database
+        every LAYOUT_TTL seconds, so that migrations by other processes are
+        noticed.
+
+        """
+        layout = self._layout
+        now = time.monotonic()
+        if layout is None or now - layout[2] > self.LAYOUT_TTL:
+            old_fanout = self.get_meta('old_fanout')
+            layout = (int(self.get_meta('fanout', 0)),
+                      None if old_fanout is None else int(old_fanout),
+                      now)
+            self._layout = layout
+        return layout[:2]
+
+    def set_layout(self, fanout, old_fanout=None):
+        """Record the storage layout.  See layout()."""
+        with self.transaction():
+            self.set_meta('fanout', fanout)
+            if old_fanout is None:
+                self.conn.execute("DELETE FROM meta WHERE key='old_fanout'")
+            else:
+                self.set_meta('old_fanout', old_fanout)
+        self._layout = None
+
+    def layout_path(self, fid, fanout):
+        """Return path of file with given fid in a layout with given fanout."""
+        shards = [fid[i * 2:i * 2 + 2] for i in range(fanout)]
+        return os.path.join(self.files_dir, *shards, fid)
+
     def fid_path(self, fid):
         """Return path to file with given fid."""
-        return os.path.join(self.files_dir, fid)
+        fanout, old_fanout = self.layout()
+        path = self.layout_path(fid, fanout)
+        if old_fanout is not None and not os.path.exists(path):
+            old_path = self.layout_path(fid, old_fanout)
+            # If the file was moved after checking path, it's at path now.
+            if os.path.exists(old_path):
+                return old_path
+        return path
+
+    def manifest_path(self, fid):
+        """Return path to the manifest of a chunked file."""
+        return self.fid_path(fid + MANIFEST_SUFFIX)
+
+    def is_chunked(self, fid):
+        """Return whether a file is stored in chunks.  See dbooru.chunks."""
+        return os.path.exists(self.manifest_path(fid))
+
+    @property
+    def chunk_threshold(self):
+        """Size from which new files are stored in chunks, or None.
+
+        Like the layout, this is reread from the database every LAYOUT_TTL
+        seconds.
+
+        """
+        cached = self._chunk_threshold
+        now = time.monotonic()
+        if cached is None or now - cached[1] > self.LAYOUT_TTL:
+            threshold = self.get_meta('chunk_threshold')
+            cached = (None if threshold is None else int(threshold), now)
+            self._chunk_threshold = cached
+        return cached[0]
+
+    def set_chunk_threshold(self, threshold):
+        """Set size from which new files are stored in chunks.
+
+        None disables chunked storage for new files.  Existing files are
+        not changed.
+
+        """
+        if threshold is None:
+            with self.transaction() as conn:
+                conn.execute("DELETE FROM meta WHERE key='chunk_threshold'")
+        else:
+            self.set_meta('chunk_threshold', int(threshold))
+        self._chunk_threshold = None
+
+    def store_path(self, fid):
+        """Return path to store a new file with given fid at.
+
+        Parent directories are created as needed.
+
+        """
+        path = self.layout_path(fid, self.layout()[0])
+        _touch_dir(os.path.dirname(path))
+        return path
 
     def create(self):
         """Create a file."""
         return _FileWrapper(self)
 
+    def exists(self, fid):
+        """Return whether a file with the given fid is stored."""
+        return os.path.exists(self.fid_path(fid)) or self.is_chunked(fid)
+
     def stat(self, fid):
-        """Return a stored file's stat structure."""
-        return os.stat(self.fid_path(fid))
+        """Return a stored file's stat structure.
+
+        For chunked files, this is the stat structure of the manifest with
+        the size of the file.
+
+        """
+        try:
+            return os.stat(self.fid_path(fid))
+        except FileNotFoundError:
+            path = self.manifest_path(fid)
+            st = os.stat(path)
+        fields = list(st)
+        fields[stat.ST_SIZE] = self.chunk_store.manifest(path).size
+        return os.stat_result(fields, {
+            name: getattr(st, name)
+            for name in ('st_atime', 'st_mtime', 'st_ctime', 'st_blksize',
+                         'st_blocks', 'st_rdev')})
 
     def delete(self, fid):
-        """Delete stored file."""
-        os.unlink(self.fid_path(fid))
-        conn = self.connect_to_db()
-        cur = conn.cursor()
-        cur.execute('DELETE FROM files WHERE fid=?', fid)
-        conn.commit()
-        conn.close()
+        """Delete stored file.
+
+        The database change is buffered in the journal.
+
+        """
+        if self.is_chunked(fid):
+            self.journal.delete_file(fid, fid + MANIFEST_SUFFIX)
+        else:
+            self.journal.delete_file(fid)
+        self.map_cache.discard(fid)
+        self.attr_cache.pop(fid)
+        self._inode_cache.pop(fid)
+        self.changed()
+
+    def inode(self, fid):
+        """Return the inode number of a stored file.
+
+        Inode numbers are assigned when a file is first recorded and are
+        never reused, so they are stable across mounts.
+
+        Raises KeyError if the file isn't recorded.
+
+        """
+        ino = self._inode_cache.get(fid)
+        if ino is None:
+            if self.journal.is_pending(fid):
+                self.journal.flush()
+            elif not self.may_have_file(fid):
+                raise KeyError(fid)
+            else:
+                ino = self._snapshot_inode(fid)
+            if ino is None:
+                with self.stats.timer('sqlite.inode'):
+                    row = self.conn.execute(
+                        'SELECT ino FROM files WHERE fid=?',
+                        (fid,)).fetchone()
+                if row is None:
+                    raise KeyError(fid)
+                ino = row[0]
+            self._inode_cache.put(fid, ino)
+        return ino
+
+    def may_have_file(self, fid):
+        """Return whether a file may be recorded.
+
+        This checks an in-memory Bloom filter of recorded fids, so most
+        unknown fids are rejected without a database query.  The filter is
+        built in the background on first use, and updated before returning
+        False if this backend changed anything since it was last updated or
+        if FILTER_TTL has passed, so files recorded by other processes are
+        found within FILTER_TTL.
+
+        """
+        return self._may_contain('_fid_filter', fid)
+
+    def may_have_key(self, key):
+        """Return whether any file may have attribute key.
+
+        See may_have_file().
+
+        """
+        return self._may_contain('_key_filter', key)
+
+    def _may_contain(self, name, item):
+        with self._filter_lock:
+            item_filter = getattr(self, name)
+            if item_filter is None:
+                self._request_filters(name)
+                return self._snapshot_contains(name, item)
+            if item in item_filter:
+                return True
+            checked = self._filter_checked
+            if (checked is not None and checked[0] == self.version
+                    and time.monotonic() - checked[1] < self.FILTER_TTL):
+                return False
+            self._update_filters()
+            item_filter = getattr(self, name)
+            return item_filter is None or item in item_filter
+
+    def _request_filters(self, *names):
+        """Have the builder thread build filters, starting it if needed.
+
+        Building reads all fids or keys, which can take seconds for large
+        instances, so lookups don't wait for it.  Call with _filter_lock
+        held.
+
+        """
+        self._filter_requests.update(names)
+        if self._filter_builder is None:
+            self._filter_builder = threading.Thread(
+                target=self._run_filter_builder, name='dbooru-filters',
+                daemon=True)
+            self._filter_builder.start()
+        self._filter_cond.notify()
+
+    def _run_filter_builder(self):
+        while True:
+            with self._filter_cond:
+                while not self._filter_requests and not self._filter_stop:
+                    self._filter_cond.wait()
+                if self._filter_stop:
+                    return
+                requests = self._filter_requests
+                self._filter_requests = set()
+            try:
+                self._build_filters(requests)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception('Building filters failed')
+                with self._filter_cond:
+                    self._filter_requests.update(requests)
+                    self._filter_cond.wait(self.FILTER_TTL)
+
+    def _build_filters(self, names):
+        """Build the named filters.  Called by the builder thread."""
+        fid_filter = key_filter = None
+        with self.stats.timer('filters.build'):
+            seq, serial = self._filter_serials()
+            if '_fid_filter' in names:
+                fid_filter = BloomFilter(max(self.file_count() * 2, 1024))
+                fid_filter.update(fid for fid, in self.conn.execute(
+                    'SELECT fid FROM files WHERE ino<=?', (seq,)))
+            if '_key_filter' in names:
+                key_filter = BloomFilter(max(self.tag_key_count() * 2, 1024))
+                key_filter.update(key for key, in self.conn.execute(
+                    'SELECT key FROM tag_keys'))
+        with self._filter_lock:
+            if fid_filter is not None:
+                self._fid_filter, self._fid_seq = fid_filter, seq
+            if key_filter is not None:
+                self._key_filter, self._key_serial = key_filter, serial
+            # Changes made while building are found on the next check.
+            self._filter_checked = None
+            if self._fid_filter is not None and self._key_filter is not None:
+                self._close_snapshot()
+
+    def _serials(self):
+        """Return serials identifying the recorded files and keys.
+
+        Returns:
+            Tuple of the generation, the files table's AUTOINCREMENT sequence,
+            the file_deletes setting and the tag_key_serial setting.  Files
+            were only added if the sequence changed and the number of
+            deletes didn't, and keys were added if the key serial changed.
+
+        """
+        seq, deletes, serial = self.conn.execute(
+            '''SELECT (SELECT seq FROM sqlite_sequence WHERE name='files'),
+            (SELECT val FROM meta WHERE key='file_deletes'),
+            (SELECT val FROM meta WHERE key='tag_key_serial')''').fetchone()
+        return self.generation, seq or 0, int(deletes or 0), int(serial or 0)
+
+    def _filter_serials(self):
+        """Return files sequence and key serial; see _update_filters()."""
+        _, seq, _, serial = self._serials()
+        return seq, serial
+
+    @property
+    def snapshot_path(self):
+        """Path of the index snapshot."""
+        return os.path.join(self.root, 'index.snapshot')
+
+    def write_snapshot(self):
+        """Write an index snapshot of the recorded fids and keys.
+
+        See open_snapshot().  Call this when unmounting, or periodically as a
+        checkpoint.
+
+        """
+        self.journal.flush()
+        conn = self.conn
+        with self.stats.timer('snapshot.write'):
+            # Read everything in one transaction, so the snapshot is
+            # consistent with the serials.
+            conn.execute('BEGIN')
+            try:
+                write_snapshot(self.snapshot_path, conn, self._serials())
+            finally:
+                conn.execute('COMMIT')
+
+    def open_snapshot(self):
+        """Open the index snapshot and start building the Bloom filters.
+
+        Until the filters are built in the background (see may_have_file()),
+        fids and keys are looked up in the memory mapped snapshot and the
+        files recorded since it was written, so lookups are answered without
+        waiting to read the whole database.  Inode numbers of files in the
+        snapshot are taken from it too.
+
+        The snapshot isn't used if any files were deleted since it was
+        written, and is dropped as soon as this backend changes anything.
+        Until the filters are built, files deleted by other processes after
+        the snapshot was opened may still be found, and files they record
+        may not be.
+
+        Returns:
+            Whether the snapshot was opened.
+
+        """
+        try:
+            snapshot = IndexSnapshot(self.snapshot_path)
+        except (FileNotFoundError, SnapshotError):
+            return False
+        generation, seq, deletes, serial = self._serials()
+        if (snapshot.generation != generation
+                or snapshot.file_deletes != deletes
+                or snapshot.files_seq > seq):
+            snapshot.close()
+            return False
+        new_fids = dict(self.conn.execute(
+            'SELECT fid, ino FROM files WHERE ino>?', (snapshot.files_seq,)))
+        with self._filter_lock:
+            self._close_snapshot()
+            self._snapshot = _OpenSnapshot(
+                snapshot, new_fids, snapshot.key_serial == serial,
+                self.version)
+            self._request_filters('_fid_filter', '_key_filter')
+        return True
+
+    def _current_snapshot(self):
+        """Return the usable _OpenSnapshot, or None.
+
+        Call with _filter_lock held.
+
+        """
+        state = self._snapshot
+        if state is not None and state.version != self.version:
+            self._close_snapshot()
+            return None
+        return state
+
+    def _close_snapshot(self):
+        """Close the snapshot.  Call with _filter_lock held."""
+        if self._snapshot is not None:
+            self._snapshot.snapshot.close()
+            self._snapshot = None
+
+    def _snapshot_contains(self, name, item):
+        """Return whether a fid or key may exist, from the snapshot.
+
+        Call with _filter_lock held.
+
+        """
+        state = self._current_snapshot()
+        if state is None:
+            return True
+        if name == '_fid_filter':
+            return (item in state.new_fids
+                    or state.snapshot.inode(item) is not None)
+        return not state.keys_current or state.snapshot.has_key(item)
+
+    def _snapshot_inode(self, fid):
+        """Return ino column value of a fid from the snapshot, or None."""
+        with self._filter_lock:
+            state = self._current_snapshot()
+            if state is None:
+                return None
+            ino = state.new_fids.get(fid)
+            if ino is None:
+                ino = state.snapshot.inode(fid)
+            return ino
+
+    def _update_filters(self):
+        """Bring the filters up to date with the database.
+
+        New files are found with the files table's AUTOINCREMENT sequence
+        and added to the fid filter, unless it is full, in which case it is
+        rebuilt.  The key filter is rebuilt if keys were added, as found with
+        the tag_key_serial setting.  Filters being rebuilt are None.  Deleted
+        files and keys are left in the filters.  Call with _filter_lock held.
+
+        """
+        version = self.version
+        seq, serial = self._filter_serials()
+        if self._fid_filter is not None:
+            if self._fid_filter.is_full():
+                self._fid_filter = None
+                self._request_filters('_fid_filter')
+            elif seq > self._fid_seq:
+                self._fid_filter.update(fid for fid, in self.conn.execute(
+                    'SELECT fid FROM files WHERE ino>? AND ino<=?',
+                    (self._fid_seq, seq)))
+                self._fid_seq = seq
+        if self._key_filter is not None and serial != self._key_serial:
+            self._key_filter = None
+            self._request_filters('_key_filter')
+        self._filter_checked = (version, time.monotonic())
+
+    def fid(self, ino):
+        """Return the fid of the stored file with the given inode number.
+
+        Raises KeyError if there is no such file.
+
+        """
+        row = self.conn.execute(
+            'SELECT fid FROM files WHERE ino=?', (ino,)).fetchone()
+        if row is None:
+            raise KeyError(ino)
+        return row[0]
+
+    def list_files(self, after=0, limit=1000):
+        """Return list of (fid, ino column value) pairs of recorded files.
+
+        Files are listed in ino order, starting after the given ino column
+        value, so a listing can be resumed from the last ino returned.
+
+        """
+        with self.stats.timer('sqlite.list_files'):
+            return self.conn.execute(
+                'SELECT fid, ino FROM files WHERE ino>? ORDER BY ino LIMIT ?',
+                (after, limit)).fetchall()
+
+    @property
+    def generation(self):
+        """Generation of inode numbers returned by inode().
+
+        This changes if inode numbers are ever reassigned, such as when
+        migrating an old instance.
+
+        """
+        if self._generation is None:
+            self._generation = int(self.get_meta('generation', 0))
+        return self._generation
+
+    def get_meta(self, key, default=None):
+        """Return value of an instance metadata setting."""
+        row = self.conn.execute(
+            'SELECT val FROM meta WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_meta(self, key, val):
+        """Set an instance metadata setting."""
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (key, val))
+
+    def get_attrs(self, fid):
+        """Return dict of a stored file's attributes."""
+        return dict(self.journal.get_attrs(fid))
+
+    def read_attrs(self, fid):
+        """Return dict of a stored file's attributes from the database.
+
+        This doesn't include changes buffered in the journal.
+
+        """
+        with self.stats.timer('sqlite.read_attrs'):
+            return dict(self.conn.execute(
+                'SELECT key, val FROM attributes WHERE fid=?', (fid,)))
+
+    def set_attr(self, fid, key, val):
+        """Set an attribute on a stored file."""
+        self.journal.set_attr(fid, key, val)
+        self.journal.flush()
+
+    def delete_attr(self, fid, key):
+        """Delete an attribute from a stored file.
+
+        Raises KeyError if the file doesn't have the attribute.
+
+        """
+        self.journal.delete_attr(fid, key)
+        self.journal.flush()
+
+    def tags(self, prefix='', limit=None):
+        """Return list of (key, count) of attribute keys starting with prefix.
+
+        count is the number of files with the attribute.  Keys are sorted,
+        and found with a range scan of the tag vocabulary, which is kept up
+        to date by triggers on the attributes table.
+
+        """
+        return self._vocabulary('tag_keys', 'key', {}, prefix, limit)
+
+    def tag_values(self, key, prefix='', limit=None):
+        """Return list of (val, count) of values of key starting with prefix.
+
+        count is the number of files with the value.  See tags().
+
+        """
+        return self._vocabulary(
+            'tag_values', 'val', {'key': key}, prefix, limit)
+
+    def tag_count(self, key, val=None):
+        """Return number of files with attribute key, or with key set to val.
+
+        See tags().
+
+        """
+        if not self.may_have_key(key):
+            return 0
+        if val is None:
+            row = self.conn.execute(
+                'SELECT count FROM tag_keys WHERE key=?', (key,)).fetchone()
+        else:
+            row = self.conn.execute(
+                'SELECT count FROM tag_values WHERE key=? AND val=?',
+                (key, val)).fetchone()
+        return row[0] if row is not None else 0
+
+    def tag_pair_count(self, key1, key2):
+        """Return number of files with both attribute keys.
+
+        Co-occurrence counts are only kept for pairs of the most frequent
+        keys; see refresh_tag_pairs().  Returns None for other pairs.
+
+        """
+        if key1 > key2:
+            key1, key2 = key2, key1
+        row = self.conn.execute(
+            '''SELECT (SELECT count FROM tag_pairs WHERE key1=? AND key2=?),
+            (SELECT COUNT(*) FROM tag_tracked WHERE key IN (?, ?))''',
+            (key1, key2, key1, key2)).fetchone()
+        if row[1] < 2:
+            return None
+        return row[0] or 0
+
+    def tag_key_count(self):
+        """Return number of distinct attribute keys."""
+        return int(self.get_meta('tag_key_count', 0))
+
+    def file_count(self):
+        """Return number of recorded files."""
+        return int(self.get_meta('file_count', 0))
+
+    def refresh_tag_pairs(self, top=None):
+        """Choose the keys to keep co-occurrence counts for and count them.
+
+        Counts are kept for pairs of the top most frequent keys, and are then
+        kept up to date by triggers.  New keys are tracked while fewer than
+        top keys are.  As frequencies change, this should be
+        run occasionally to track the current most frequent keys.
+
+        Args:
+            top: Number of keys to track.  Defaults to the previous number,
+                initially DEFAULT_TAG_PAIRS.
+
+        """
+        if top is None:
+            top = int(self.get_meta('tag_pairs', self.DEFAULT_TAG_PAIRS))
+        with self.transaction() as conn:
+            self.set_meta('tag_pairs', top)
+            conn.execute('DELETE FROM tag_tracked')
+            conn.execute(
+                '''INSERT INTO tag_tracked
+                SELECT key FROM tag_keys ORDER BY count DESC LIMIT ?''',
+                (top,))
+            conn.execute('DELETE FROM tag_pairs')
+            conn.execute(
+                '''INSERT INTO tag_pairs
+                SELECT a.key, b.key, COUNT(*)
+                FROM tag_tracked AS t
+                JOIN attributes AS a INDEXED BY attributes_key_val
+                ON a.key=t.key
+                JOIN attributes AS b ON b.fid=a.fid AND b.key>a.key
+                WHERE b.key IN (SELECT key FROM tag_tracked)
+                GROUP BY a.key, b.key''')
+
+    def _vocabulary(self, table, column, equal, prefix, limit):
+        """Run a prefix range query on a tag vocabulary table.
+
+        Args:
+            table: Vocabulary table name.
+            column: Column to match prefix on and return with counts.
+            equal: Dict mapping other columns to required values.
+            prefix: Prefix of column.
+            limit: Maximum number of rows, or None.
+
+        """
+        conds = [name + '=?' for name in equal]
+        params = list(equal.values())
+        if prefix:
+            conds.append(column + '>=?')
+            params.append(prefix)
+            bound = _prefix_bound(prefix)
+            if bound is not None:
+                conds.append(column + '<?')
+                params.append(bound)
+        sql = 'SELECT {0}, count FROM {1}'.format(column, table)
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY ' + column
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self.stats.timer('sqlite.vocabulary'):
+            return self.conn.execute(sql, params).fetchall()
 
     def connect_to_db(self):
-        """Connect to metadata database."""
-        return sqlite3.connect(self.db_file)
+        """Open a new connection to the metadata database.
+
+        Most code should use the conn property or transaction() instead, which
+        reuse the calling thread's connection.
+
+        """
+        # Connections are only used by the thread that created them, but
+        # close() may be called from a different thread.
+        conn = sqlite3.connect(
+            self.db_file, timeout=self.busy_timeout, isolation_level=None,
+            check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        conn.execute('PRAGMA mmap_size={:d}'.format(self.mmap_size))
+        conn.execute('PRAGMA foreign_keys=ON')
+        # Attribute rows replaced on conflict must fire the delete triggers
+        # maintaining the tag vocabulary.
+        conn.execute('PRAGMA recursive_triggers=ON')
+        return conn
+
+    @property
+    def conn(self):
+        """Database connection for the current thread.
+
+        The connection is in autocommit mode; use transaction() to group
+        statements.
+
+        """
+        try:
+            return self._local.conn
+        except AttributeError:
+            pass
+        conn = self.connect_to_db()
+        with self._conns_lock:
+            self._conns.append(conn)
+        self._local.conn = conn
+        self._local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager grouping database operations into one commit.
+
+        Returns the current thread's connection.  The transaction is
+        committed on exit, or rolled back if an exception is raised.  Nested
+        calls join the outermost transaction.
+
+            with backend.transaction() as conn:
+                conn.execute(...)
+                conn.execute(...)
+
+        """
+        conn = self.conn
+        local = self._local
+        if local.depth:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+        # Take the write lock up front, so concurrent transactions wait for
+        # each other instead of failing when upgrading a read lock.
+        start = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            local.depth = 0
+            self.stats.record('sqlite.transaction',
+                              time.perf_counter() - start)
+
+    def cache_stats(self):
+        """Return dict of statistics of the backend's caches."""
+        return {
+            'attr_cache': self.attr_cache.stats(),
+            'inode_cache': self._inode_cache.stats(),
+            'journal_cache': self.journal.cache.stats(),
+            'map_cache': self.map_cache.stats(),
+            'chunk_cache': self.chunk_store.cache.stats(),
+            'fid_filter': (self._fid_filter.stats()
+                           if self._fid_filter is not None else None),
+            'key_filter': (self._key_filter.stats()
+                           if self._key_filter is not None else None),
+        }
 
-    def init(self):
-        """Initialize dbooru instance."""
+    def recover(self):
+        """Recover from a crash with uncommitted metadata changes.
+
+        Call this before using an instance that may not have been closed
+        cleanly.
+
+        """
+        self.journal.recover()
+
+    def close(self):
+        """Flush buffered changes and close all pooled connections."""
+        with self._filter_cond:
+            self._filter_stop = True
+            self._filter_cond.notify()
+            builder = self._filter_builder
+        if builder is not None:
+            builder.join()
+        with self._filter_lock:
+            self._filter_builder = None
+            self._filter_stop = False
+            self._close_snapshot()
+        self.journal.close()
+        self.map_cache.clear()
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+    def init(self, fanout=2, chunk_threshold=None):
+        """Initialize dbooru instance.
+
+        Args:
+            fanout: Storage layout fanout for a new instance.  See layout().
+                Existing instances keep their layout.
+            chunk_threshold: If given, set size from which new files are
+                stored in chunks.  See set_chunk_threshold().
+
+        """
         _touch_dir(self.root)
         _touch_dir(self.files_dir)
-        conn = self.connect_to_db()
-        cur = conn.cursor()
-        cur.execute(
-            '''CREATE TABLE files (fid text)''')
-        cur.execute(
-            '''CREATE TABLE attributes (fid text, key text, val text,
-            PRIMARY KEY (fid, key) ON CONFLICT REPLACE,
-            FORIEGN KEY (fid) REFERENCES files (fid) ON DELETE CASCADE)''')
-        conn.commit()
-        conn.close()
+        _touch_dir(self.staging_dir)
+        new = not self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='files'").fetchone()
+        self._migrate_files_table()
+        with self.transaction() as conn:
+            # AUTOINCREMENT so inode numbers are never reused.
+            conn.execute(
+                '''CREATE TABLE IF NOT EXISTS files (
+                ino INTEGER PRIMARY KEY AUTOINCREMENT,
+                fid text UNIQUE NOT NULL)''')
+            conn.execute(
+                '''CREATE TABLE IF NOT EXISTS attributes (
+                fid text, key text, val text,
+                PRIMARY KEY (fid, key) ON CONFLICT REPLACE,
+                FOREIGN KEY (fid) REFERENCES files (fid) ON DELETE CASCADE)''')
+            # Covering index for tag queries.
+            conn.execute(
+                '''CREATE INDEX IF NOT EXISTS attributes_key_val
+                ON attributes (key, val, fid)''')
+            conn.execute(
+                '''CREATE TABLE IF NOT EXISTS meta (
+                key text PRIMARY KEY, val)''')
+            self._create_vocabulary()
+            self._create_tag_stats()
+            if new:
+                self.set_layout(fanout)
+            if chunk_threshold is not None:
+                self.set_chunk_threshold(chunk_threshold)
+        self.recover()
+
+    def _create_vocabulary(self):
+        """Create the tag vocabulary tables and the triggers maintaining them.
+
+        tag_keys counts files per attribute key and tag_values counts files
+        per key and value.  Rows are removed when their count reaches zero.
+        The tables are filled from the attributes table when first created,
+        and the triggers are recreated every time.
+
+        """
+        conn = self.conn
+        new = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='tag_keys'").fetchone()
+        conn.execute(
+            '''CREATE TABLE IF NOT EXISTS tag_keys (
+            key text PRIMARY KEY, count integer NOT NULL) WITHOUT ROWID''')
+        conn.execute(
+            '''CREATE TABLE IF NOT EXISTS tag_values (
+            key text, val text, count integer NOT NULL,
+            PRIMARY KEY (key, val)) WITHOUT ROWID''')
+        # Not INSERT OR IGNORE: statements adding attributes with a conflict
+        # clause, such as INSERT OR REPLACE, override it, replacing counts.
+        add = '''
+            INSERT INTO tag_keys SELECT new.key, 0
+            WHERE NOT EXISTS (SELECT 1 FROM tag_keys WHERE key=new.key);
+            UPDATE tag_keys SET count=count+1 WHERE key=new.key;
+            INSERT INTO tag_values SELECT new.key, new.val, 0
+            WHERE NOT EXISTS (SELECT 1 FROM tag_values
+                              WHERE key=new.key AND val=new.val);
+            UPDATE tag_values SET count=count+1
+            WHERE key=new.key AND val=new.val;'''
+        remove = '''
+            UPDATE tag_keys SET count=count-1 WHERE key=old.key;
+            DELETE FROM tag_keys WHERE key=old.key AND count<1;
+            UPDATE tag_values SET count=count-1
+            WHERE key=old.key AND val=old.val;
+            DELETE FROM tag_values
+            WHERE key=old.key AND val=old.val AND count<1;'''
+        # Recreated so that instances get the current trigger definitions.
+        for name in ('insert', 'delete', 'update'):
+            conn.execute('DROP TRIGGER IF EXISTS tag_vocabulary_' + name)
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_vocabulary_insert
+            AFTER INSERT ON attributes BEGIN {} END'''.format(add))
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_vocabulary_delete
+            AFTER DELETE ON attributes BEGIN {} END'''.format(remove))
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_vocabulary_update
+            AFTER UPDATE OF key, val ON attributes
+            BEGIN {} {} END'''.format(remove, add))
+        if new:
+            conn.execute(
+                '''INSERT INTO tag_keys
+                SELECT key, COUNT(*) FROM attributes GROUP BY key''')
+            conn.execute(
+                '''INSERT INTO tag_values
+                SELECT key, val, COUNT(*) FROM attributes GROUP BY key, val''')
+
+    def _create_tag_stats(self):
+        """Create the tag statistics tables and the triggers maintaining them.
+
+        tag_pairs counts files per pair of keys in tag_tracked, with the
+        smaller key first.  The triggers assume attribute keys are only
+        changed by inserting and deleting rows, as all backend code does.
+        The file_count and tag_key_count settings count the files and
+        tag_keys tables, and file_deletes and tag_key_serial count files ever
+        deleted and keys ever added.
+
+        """
+        conn = self.conn
+        new = not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='tag_pairs'").fetchone()
+        conn.execute(
+            '''CREATE TABLE IF NOT EXISTS tag_tracked (
+            key text PRIMARY KEY) WITHOUT ROWID''')
+        conn.execute(
+            '''CREATE TABLE IF NOT EXISTS tag_pairs (
+            key1 text, key2 text, count integer NOT NULL,
+            PRIMARY KEY (key1, key2)) WITHOUT ROWID''')
+        # Pairs of the changed key with the file's other tracked keys.
+        pairs = '''
+            SELECT min(a.key, {0}.key) AS key1, max(a.key, {0}.key) AS key2
+            FROM attributes AS a
+            WHERE a.fid={0}.fid AND a.key!={0}.key
+            AND a.key IN (SELECT key FROM tag_tracked)
+            AND {0}.key IN (SELECT key FROM tag_tracked)'''
+        # Keys are tracked as they are added until there are enough.  Rows
+        # are added with NOT EXISTS guards rather than INSERT OR IGNORE,
+        # which conflict clauses of the statements adding attributes
+        # override; see _create_vocabulary().
+        add = '''
+            INSERT INTO tag_tracked SELECT new.key
+            WHERE (SELECT COUNT(*) FROM tag_tracked)
+            < (SELECT val FROM meta WHERE key='tag_pairs')
+            AND NOT EXISTS (SELECT 1 FROM tag_tracked WHERE key=new.key);
+            INSERT INTO tag_pairs SELECT key1, key2, 0 FROM ({0}) AS p
+            WHERE NOT EXISTS (SELECT 1 FROM tag_pairs AS t
+                              WHERE t.key1=p.key1 AND t.key2=p.key2);
+            UPDATE tag_pairs SET count=count+1
+            WHERE (key1, key2) IN (SELECT key1, key2 FROM ({0}));'''.format(
+                pairs.format('new'))
+        remove = '''
+            UPDATE tag_pairs SET count=count-1
+            WHERE (key1, key2) IN (SELECT key1, key2 FROM ({0}));'''.format(
+                pairs.format('old'))
+        # Recreated so that instances get the current trigger definitions.
+        for name in ('insert', 'delete'):
+            conn.execute('DROP TRIGGER IF EXISTS tag_pairs_' + name)
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_pairs_insert
+            AFTER INSERT ON attributes BEGIN {} END'''.format(add))
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_pairs_delete
+            AFTER DELETE ON attributes
+            WHEN old.key IN (SELECT key FROM tag_tracked)
+            BEGIN {} END'''.format(remove))
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS file_count_insert
+            AFTER INSERT ON files BEGIN
+            UPDATE meta SET val=val+1 WHERE key='file_count'; END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS file_count_delete
+            AFTER DELETE ON files BEGIN
+            UPDATE meta SET val=val-1 WHERE key='file_count'; END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_key_count_insert
+            AFTER INSERT ON tag_keys BEGIN
+            UPDATE meta SET val=val+1 WHERE key='tag_key_count'; END''')
+        conn.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('file_deletes', 0)")
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS file_deletes_delete
+            AFTER DELETE ON files BEGIN
+            UPDATE meta SET val=val+1 WHERE key='file_deletes'; END''')
+        # Only increases, so backends can tell when keys were added.
+        conn.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('tag_key_serial', 0)")
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_key_serial_insert
+            AFTER INSERT ON tag_keys BEGIN
+            UPDATE meta SET val=val+1 WHERE key='tag_key_serial'; END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS tag_key_count_delete
+            AFTER DELETE ON tag_keys BEGIN
+            UPDATE meta SET val=val-1 WHERE key='tag_key_count'; END''')
+        if new:
+            self.set_meta('file_count', conn.execute(
+                'SELECT COUNT(*) FROM files').fetchone()[0])
+            self.set_meta('tag_key_count', conn.execute(
+                'SELECT COUNT(*) FROM tag_keys').fetchone()[0])
+            self.refresh_tag_pairs()
+
+    def _migrate_files_table(self):
+        """Add inode numbers to a files table from before they existed."""
+        conn = self.conn
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(files)')]
+        if not columns or 'ino' in columns:
+            return
+        # Foreign keys must be disabled to replace a referenced table, and
+        # can't be changed inside a transaction.
+        conn.execute('PRAGMA foreign_keys=OFF')
+        try:
+            with self.transaction():
+                conn.execute(
+                    '''CREATE TABLE files_new (
+                    ino INTEGER PRIMARY KEY AUTOINCREMENT,
+                    fid text UNIQUE NOT NULL)''')
+                # Old versions could record a file more than once.  Rows
+                # refer to files by fid, so dropping the duplicates leaves
+                # attributes attached.
+                conn.execute(
+                    '''INSERT INTO files_new (fid)
+                    SELECT fid FROM files WHERE fid IS NOT NULL
+                    GROUP BY fid ORDER BY MIN(rowid)''')
+                conn.execute('DROP TABLE files')
+                conn.execute('ALTER TABLE files_new RENAME TO files')
+                conn.execute(
+                    '''CREATE TABLE IF NOT EXISTS meta (
+                    key text PRIMARY KEY, val)''')
+                self.set_meta('generation', self.generation + 1)
+        finally:
+            conn.execute('PRAGMA foreign_keys=ON')
+        self._generation = None
+
+
+def hash_path(path):
+    """Return the fid for the file at the given path."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            data = file.read(_HASH_CHUNK_LENGTH)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _prefix_bound(prefix):
+    """Return the smallest string greater than every string with prefix.
+
+    Returns None if there is no such string.
+
+    """
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # Surrogates can't be encoded in UTF-8.
+        code = 0xE000
+    return prefix[:-1] + chr(code)
 
 
 def _touch_dir(path):
@@ -98,12 +1181,22 @@ class _FileWrapper:
 
     """Wrapper to support file creation in dbooru.
 
-    When an instance is created, a temporary file descriptor is made, which can
-    be accessed using the fd attribute.  This file descriptor can be used to
-    write the contents of the file.  When the file is completely written, it is
+    When an instance is created, a temporary file is made.  The contents of
+    the file are written using the write() and pwrite() methods, which hash
+    the data as it is written.  When the file is completely written, it is
     finalized by calling the close() method, which will close the file
-    descriptor, calculate its hash to use as its fid, then move the temporary
-    file to its final location.
+    descriptor, use the hash as its fid, then move the temporary file to its
+    final location.  The fid is then available as the fid attribute.  If a file
+    with the same fid is already stored, the temporary file is discarded and
+    neither the stored file nor the database is touched.  The file can instead
+    be discarded by calling the abort() method.  Once closed or discarded, the
+    fd attribute is None and writes raise ValueError.
+
+    If large files are stored in chunks, the chunks are found as the data is
+    written too.  If the data was not written strictly sequentially, the hash
+    and chunks are calculated by reading back the file when it is closed.
+    The underlying file descriptor is available as the fd attribute, but data
+    written directly to it is not hashed as it is written.
 
     This class can be used as a context manager, in which case it returns a
     binary writable file object:
@@ -117,33 +1210,125 @@ class _FileWrapper:
 
     def __init__(self, backend):
         self._backend = backend
-        self.fd, self._path = tempfile.mkstemp()
+        self.fd, self._path = tempfile.mkstemp(dir=backend.staging_dir)
+        self.fid = None
         self._file = None
+        self._pos = 0
+        # Hash of the first _hashed bytes of the file, or None if the file was
+        # written out of order.
+        self._hasher = hashlib.sha256()
+        self._hashed = 0
+        # Finds the file's chunks as it is written, if large files are
+        # chunked, so it doesn't have to be read back to store it in chunks.
+        self._chunker = None
+        if backend.chunk_threshold is not None:
+            self._chunker = backend.chunk_store.chunker()
 
     def __enter__(self):
-        self._file = os.fdopen(self.fd, 'wb')
+        self._file = io.BufferedWriter(
+            _HashingWriter(self), buffer_size=self._PROCESS_LENGTH)
         return self._file
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
         self._file.close()
         self.close()
 
+    def _check_open(self):
+        if self.fd is None:
+            raise ValueError('File was already closed or discarded')
+
+    def write(self, buf):
+        """Write data at the current position and return bytes written."""
+        self._check_open()
+        written = os.write(self.fd, buf)
+        self._update_hash(self._pos, buf, written)
+        self._pos += written
+        return written
+
+    def pwrite(self, buf, off):
+        """Write data at the given offset and return bytes written."""
+        self._check_open()
+        written = os.pwrite(self.fd, buf, off)
+        self._update_hash(off, buf, written)
+        return written
+
+    def _update_hash(self, off, buf, length):
+        """Update hash with data written at offset."""
+        if self._hasher is None:
+            return
+        if off != self._hashed:
+            self._hasher = self._chunker = None
+            return
+        data = memoryview(buf)[:length]
+        self._hasher.update(data)
+        if self._chunker is not None:
+            self._chunker.update(data)
+        self._hashed += length
+
+    def abort(self):
+        """Discard the file.  Does nothing if already closed or discarded."""
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        if self._file is not None:
+            # Close the buffered file object now, discarding its buffer, so
+            # it can't be flushed later to whatever file reuses fd.
+            try:
+                self._file.close()
+            except ValueError:
+                pass
+        os.close(fd)
+        os.unlink(self._path)
+
     def close(self):
-        # Close file descriptor.
-        os.close(self.fd)
+        """Finalize the file and return its fid."""
+        self._check_open()
+        fd, self.fd = self.fd, None
+        size = os.fstat(fd).st_size
+        os.close(fd)
         # Find hash value and move file to storage.
-        hasher = hashlib.sha256()
-        with open(self._path, 'rb') as file:
-            while True:
-                data = file.read(self._PROCESS_LENGTH)
-                if not data:
-                    break
-                hasher.update(data)
-        fid = hasher.hexdigest()
-        os.rename(self._path, self._backend.fid_path(fid))
-        # Write necessary metadata for new file.
-        conn = self._backend.connect_to_db()
-        cur = conn.cursor()
-        cur.execute('INSERT INTO files VALUES (?)', fid)
-        conn.commit()
-        conn.close()
+        if self._hasher is not None and self._hashed == size:
+            fid = self._hasher.hexdigest()
+        else:
+            fid = hash_path(self._path)
+            self._chunker = None
+        self.fid = fid
+        if self._backend.exists(fid):
+            os.unlink(self._path)
+            return fid
+        # Move file to storage and buffer writing its metadata.
+        threshold = self._backend.chunk_threshold
+        if threshold is not None and size >= threshold:
+            chunk_store = self._backend.chunk_store
+            if self._chunker is not None:
+                self._chunker.finish()
+                manifest = chunk_store.store_chunks(
+                    self._path, self._chunker.chunks)
+            else:
+                manifest = chunk_store.write_manifest(self._path)
+            os.unlink(self._path)
+            self._backend.journal.add_file(fid, manifest,
+                                           fid + MANIFEST_SUFFIX)
+        else:
+            self._backend.journal.add_file(fid, self._path)
+        self._backend.attr_cache.pop(fid)
+        self._backend.changed()
+        return fid
+
+
+class _HashingWriter(io.RawIOBase):
+
+    """Raw file object that writes through a _FileWrapper."""
+
+    def __init__(self, wrapper):
+        super().__init__()
+        self._wrapper = wrapper
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._wrapper.write(b)
@@ -0,0 +1,264 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.bench
+
+This module implements benchmarks for the backend and FUSE operations.
+
+A synthetic corpus is generated into a new dbooru instance, then operations
+are timed against it.  FUSE operations are timed by calling FUSEOp methods
+directly, without mounting.  Results are returned as a JSON serializable dict
+so runs on different commits can be compared.
+
+"""
+
+import math
+import os
+import platform
+import random
+import time
+
+import llfuse
+
+from dbooru import query
+from dbooru.backend import DbooruBackend
+from dbooru.fuseop import FUSEOp
+
+
+class CorpusConfig:
+
+    """Parameters for a synthetic corpus."""
+
+    # pylint: disable=too-many-arguments,too-few-public-methods
+
+    def __init__(self, files=1000, tags=50, values=4, tags_per_file=5,
+                 min_size=1024, max_size=2 ** 20, seed=0):
+        """
+        Args:
+            files: Number of files.
+            tags: Number of distinct attribute keys.
+            values: Number of distinct values per key.
+            tags_per_file: Number of attributes set on each file.
+            min_size: Minimum file size in bytes.
+            max_size: Maximum file size in bytes.  Sizes are log-uniformly
+                distributed between min_size and max_size.
+            seed: Random seed, so corpora are reproducible.
+
+        """
+        self.files = files
+        self.tags = tags
+        self.values = values
+        self.tags_per_file = min(tags_per_file, tags)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.seed = seed
+
+    def to_dict(self):
+        """Return config as a dict."""
+        return dict(vars(self))
+
+
+def _tag(index):
+    return 'tag{:04d}'.format(index)
+
+
+def _timed(func, iterable):
+    """Call func on each item and return timing statistics."""
+    times = []
+    for item in iterable:
+        start = time.perf_counter()
+        func(item)
+        times.append(time.perf_counter() - start)
+    return _summarize(times)
+
+
+def _summarize(times):
+    """Return dict of statistics for a list of durations in seconds."""
+    if not times:
+        return {'count': 0}
+    times = sorted(times)
+    total = sum(times)
+    return {
+        'count': len(times),
+        'total': total,
+        'mean': total / len(times),
+        'min': times[0],
+        'p50': _percentile(times, 0.50),
+        'p95': _percentile(times, 0.95),
+        'p99': _percentile(times, 0.99),
+        'max': times[-1],
+        'ops_per_sec': len(times) / total if total else None,
+    }
+
+
+def _percentile(sorted_times, fraction):
+    index = min(int(math.ceil(fraction * len(sorted_times))) - 1,
+                len(sorted_times) - 1)
+    return sorted_times[max(index, 0)]
+
+
+def generate_corpus(backend, config):
+    """Write a synthetic corpus into a backend.
+
+    Returns:
+        Tuple of list of fids and ingest timing statistics.
+
+    """
+    rng = random.Random(config.seed)
+    log_min = math.log(config.min_size)
+    log_max = math.log(config.max_size)
+    fids = []
+    total_bytes = 0
+    start = time.perf_counter()
+    for _ in range(config.files):
+        size = int(math.exp(rng.uniform(log_min, log_max)))
+        wrapper = backend.create()
+        with wrapper as file:
+            # Random prefix so every file has a distinct fid.
+            file.write(rng.getrandbits(256).to_bytes(32, 'little'))
+            file.write(bytes(max(size - 32, 0)))
+        fids.append(wrapper.fid)
+        total_bytes += size
+        for index in rng.sample(range(config.tags), config.tags_per_file):
+            backend.journal.set_attr(wrapper.fid, _tag(index),
+                                     str(rng.randrange(config.values)))
+    backend.journal.flush()
+    elapsed = time.perf_counter() - start
+    return fids, {
+        'files': len(fids),
+        'bytes': total_bytes,
+        'seconds': elapsed,
+        'files_per_sec': len(fids) / elapsed if elapsed else None,
+        'bytes_per_sec': total_bytes / elapsed if elapsed else None,
+    }
+
+
+def bench_backend(backend, fids, config):
+    """Time DbooruBackend metadata operations."""
+    rng = random.Random(config.seed + 1)
+    sample = [rng.choice(fids) for _ in range(min(len(fids), 1000))]
+    results = {}
+    backend.journal.cache.clear()
+    results['get_attrs_cold'] = _timed(backend.get_attrs, sample)
+    results['get_attrs_warm'] = _timed(backend.get_attrs, sample)
+    results['set_attr'] = _timed(
+        lambda fid: backend.set_attr(fid, 'bench', 'x'), sample)
+    results['journal_set_attr'] = _timed(
+        lambda fid: backend.journal.set_attr(fid, 'bench', 'y'), sample)
+    start = time.perf_counter()
+    backend.journal.flush()
+    results['journal_flush'] = _summarize([time.perf_counter() - start])
+    results['inode'] = _timed(backend.inode, sample)
+    results['stat'] = _timed(backend.stat, sample)
+    queries = [_tag(rng.randrange(config.tags)) for _ in range(50)]
+    queries += ['{} {}'.format(_tag(rng.randrange(config.tags)),
+                               _tag(rng.randrange(config.tags)))
+                for _ in range(50)]
+    results['search'] = _timed(
+        lambda text: sum(1 for _ in query.search(backend, text)), queries)
+    return results
+
+
+def _listdir(operations, inode):
+    """Return list of (name, attr) for a directory via FUSEOp."""
+    fh = operations.opendir(inode)
+    try:
+        return [(name, attr) for name, attr, _ in operations.readdir(fh, 0)]
+    finally:
+        operations.releasedir(fh)
+
+
+def _read_all(operations, inode, chunk=2 ** 17):
+    fh = operations.open(inode, os.O_RDONLY)
+    try:
+        off = 0
+        while True:
+            data = operations.read(fh, off, chunk)
+            if not data:
+                break
+            off += len(data)
+    finally:
+        operations.release(fh)
+
+
+def bench_fuse(root, config):
+    """Time FUSE operations by calling FUSEOp directly."""
+    rng = random.Random(config.seed + 2)
+    operations = FUSEOp(root)
+    results = {}
+    # FUSEOp expects to be called with the global lock held, as in
+    # llfuse.main().
+    with llfuse.lock:
+        operations.init()
+        try:
+            root_ino = llfuse.ROOT_INODE
+            tags_ino = operations.lookup(root_ino, b'tags').st_ino
+            files_ino = operations.lookup(root_ino, b'files').st_ino
+            results['readdir_files'] = _timed(
+                lambda inode: _listdir(operations, inode), [files_ino] * 3)
+            results['readdir_tags'] = _timed(
+                lambda inode: _listdir(operations, inode), [tags_ino] * 3)
+            names = [_tag(rng.randrange(config.tags)).encode()
+                     for _ in range(100)]
+            results['lookup_tag'] = _timed(
+                lambda name: operations.lookup(tags_ino, name), names)
+            tag_inodes = [operations.lookup(tags_ino, name).st_ino
+                          for name in names[:10]]
+            results['readdir_query'] = _timed(
+                lambda inode: _listdir(operations, inode), tag_inodes)
+            entries = _listdir(operations, files_ino)
+            sample = [rng.choice(entries)[0]
+                      for _ in range(min(len(entries), 1000))]
+            results['lookup_file'] = _timed(
+                lambda name: operations.lookup(files_ino, name), sample)
+            inodes = [operations.lookup(files_ino, name).st_ino
+                      for name in sample]
+            results['getattr'] = _timed(operations.getattr, inodes)
+            results['read'] = _timed(
+                lambda inode: _read_all(operations, inode), inodes[:100])
+            results['tables'] = operations.table_stats()
+        finally:
+            operations.destroy()
+    return results
+
+
+def run(root, config):
+    """Run all benchmarks in a new dbooru instance at root.
+
+    Returns:
+        JSON serializable dict of results.
+
+    """
+    backend = DbooruBackend(root)
+    backend.init()
+    try:
+        fids, ingest = generate_corpus(backend, config)
+        backend_results = bench_backend(backend, fids, config)
+    finally:
+        backend.close()
+    return {
+        'config': config.to_dict(),
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'system': platform.platform(),
+        },
+        'timestamp': time.time(),
+        'ingest': ingest,
+        'backend': backend_results,
+        'fuse': bench_fuse(root, config),
+    }
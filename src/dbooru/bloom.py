@@ -0,0 +1,93 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.bloom
+
+This module implements a Bloom filter of strings.
+
+A Bloom filter answers whether it may contain a string with no false
+negatives and a configurable rate of false positives, in a fixed number of
+bits per string.  Strings can't be removed.
+
+"""
+
+import math
+
+
+class BloomFilter:
+
+    """Bloom filter of strings.
+
+    Bit indexes are derived from the string's hash() by double hashing, so
+    filters can't be shared between processes.  Not thread safe.
+
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Args:
+            capacity: Number of strings the filter is sized for.  The false
+                positive rate increases beyond this; see is_full().
+            error_rate: False positive rate at capacity.
+
+        """
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self._bits = max(int(-self.capacity * math.log(error_rate)
+                             / math.log(2) ** 2), 8)
+        self._hashes = max(round(self._bits / self.capacity * math.log(2)), 1)
+        self._array = bytearray((self._bits + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, item):
+        # hash() of strings is cached and differs between processes, which
+        # is fine for a filter only kept in memory.
+        value = hash(item) & 0xFFFFFFFFFFFFFFFF
+        first = value & 0xFFFFFFFF
+        second = (value >> 32) | 1
+        bits = self._bits
+        return [(first + i * second) % bits for i in range(self._hashes)]
+
+    def add(self, item):
+        """Add a string."""
+        array = self._array
+        for index in self._indexes(item):
+            array[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def update(self, items):
+        """Add strings from an iterable."""
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        array = self._array
+        return all(array[index >> 3] & (1 << (index & 7))
+                   for index in self._indexes(item))
+
+    def is_full(self):
+        """Return whether more strings were added than the capacity."""
+        return self.count > self.capacity
+
+    def stats(self):
+        """Return dict of filter statistics."""
+        return {
+            'count': self.count,
+            'capacity': self.capacity,
+            'bits': self._bits,
+            'hashes': self._hashes,
+        }
@@ -0,0 +1,240 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.cache
+
+This module provides caching helpers.
+
+"""
+
+from collections import OrderedDict
+import mmap
+import os
+import threading
+
+
+class LRUCache:
+
+    """Bounded mapping that evicts the least recently used entries.
+
+    Hits and misses of get() are counted in the hits and misses attributes.
+    The cache is thread safe.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return value for key, marking it as recently used."""
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Set value for key, evicting old entries if needed."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove and return value for key."""
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return dict of cache statistics."""
+        return {
+            'size': len(self._entries),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class Mapping:
+
+    """Shared read only memory mapping of a file.
+
+    data is a memoryview of the whole file.  Slicing it doesn't copy.
+
+    """
+
+    __slots__ = ('key', 'fd', 'data', '_map', 'refs')
+
+    def __init__(self, key, path):
+        self.key = key
+        self.fd = os.open(path, os.O_RDONLY)
+        self.refs = 0
+        try:
+            size = os.fstat(self.fd).st_size
+            # Empty files can't be mapped.
+            self._map = (mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+                         if size else None)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.data = memoryview(self._map if size else b'')
+
+    def close(self):
+        """Unmap and close the file.
+
+        Raises BufferError if slices of data are still in use.
+
+        """
+        self.data.release()
+        if self._map is not None:
+            self._map.close()
+        os.close(self.fd)
+
+
+class MappingCache:
+
+    """Reference counted cache of shared file mappings.
+
+    All users of a key share one file descriptor and mapping.  Mappings
+    that are no longer referenced are kept open for reuse, up to size of
+    them, and the least recently used are closed first.  Use this only for
+    files that are never modified.  The cache is thread safe.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._idle = OrderedDict()
+        # Closed mappings whose data was still in use.
+        self._closing = []
+        self._lock = threading.Lock()
+
+    def acquire(self, key, path):
+        """Return Mapping for key, mapping the file at path if needed.
+
+        Each call must be paired with a call to release().
+
+        """
+        with self._lock:
+            mapping = self._entries.get(key)
+            if mapping is not None:
+                self.hits += 1
+                self._idle.pop(key, None)
+                mapping.refs += 1
+                return mapping
+            self.misses += 1
+        # Map outside the lock, as it does I/O.
+        new = Mapping(key, path)
+        with self._lock:
+            mapping = self._entries.setdefault(key, new)
+            self._idle.pop(key, None)
+            mapping.refs += 1
+        if mapping is not new:
+            new.close()
+        return mapping
+
+    def release(self, mapping):
+        """Release a Mapping returned by acquire()."""
+        with self._lock:
+            mapping.refs -= 1
+            if mapping.refs > 0:
+                return
+            if self._entries.get(mapping.key) is mapping:
+                self._idle[mapping.key] = mapping
+                closing = self._evict(self.size)
+            else:
+                # Discarded while in use.
+                closing = [mapping]
+        self._close(closing)
+
+    def discard(self, key):
+        """Stop caching key, closing its mapping once it's released."""
+        with self._lock:
+            mapping = self._entries.pop(key, None)
+            closing = []
+            if self._idle.pop(key, None) is not None:
+                closing.append(mapping)
+        self._close(closing)
+
+    def clear(self):
+        """Close all idle mappings."""
+        with self._lock:
+            closing = self._evict(0)
+        self._close(closing)
+
+    def _evict(self, size):
+        """Remove idle mappings beyond size and return them.
+
+        Must be called with _lock held.
+
+        """
+        closing = []
+        while len(self._idle) > size:
+            key, mapping = self._idle.popitem(last=False)
+            del self._entries[key]
+            closing.append(mapping)
+        return closing
+
+    def _close(self, closing):
+        """Close mappings, retrying ones previously in use."""
+        with self._lock:
+            closing.extend(self._closing)
+            self._closing = []
+        still_used = []
+        for mapping in closing:
+            try:
+                mapping.close()
+            except BufferError:
+                still_used.append(mapping)
+        if still_used:
+            with self._lock:
+                self._closing.extend(still_used)
+
+    def stats(self):
+        """Return dict of cache statistics."""
+        with self._lock:
+            return {
+                'open': len(self._entries),
+                'idle': len(self._idle),
+                'max_idle': self.size,
+                'closing': len(self._closing),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
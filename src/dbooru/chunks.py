@@ -0,0 +1,330 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.chunks
+
+This module implements chunked storage of large files.
+
+Large files can be split into variable sized chunks at content defined
+boundaries, which are stored once each by their SHA-256 hash.  Files that
+share most of their data, such as re-encoded or edited versions of a file,
+then share most of their chunks, even if data was inserted or removed.  The
+stored file is replaced by a manifest listing its chunks, named after the
+file's fid with MANIFEST_SUFFIX.
+
+Boundaries only depend on the bytes just before them.  Each byte is mapped
+to one bit by a fixed pseudorandom table, and a boundary is placed after a
+run of bytes whose bits are a one followed by log2(avg_size) - 1 zeros, but
+not within min_size of the previous boundary and at most max_size after it.
+Both the mapping and the search run in native code (bytes.translate() and
+bytes.find()), so chunking is much faster than a per-byte rolling hash in
+Python.  Chunks are found and hashed by a Chunker as data is written, so
+storing a file in chunks only copies its new chunks.
+
+Chunks are stored in the chunks directory, in one level of shard directories
+named after the first two hex digits of their hash.  Chunks are never
+removed when files are deleted, as other files may share them; unreferenced
+chunks are removed by dbooru.scrub.
+
+"""
+
+import bisect
+from collections import namedtuple
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
+from dbooru.cache import LRUCache
+
+MANIFEST_SUFFIX = '.chunks'
+
+# Pseudorandom but fixed, as boundaries must be the same between runs.
+_BITS = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+_READ_LENGTH = 2 ** 23  # 8 MiB
+
+# offsets are the start offsets of the chunks.
+Manifest = namedtuple('Manifest', ['size', 'hashes', 'lengths', 'offsets'])
+
+
+class Chunker:
+
+    """Finds the content defined chunks of data given in order.
+
+    The chunks found so far are in the chunks attribute, as lists of their
+    hex SHA-256 hash and length, if hash_chunks is true.  The boundaries
+    don't depend on how the data is split between update() calls.
+
+    """
+
+    def __init__(self, min_size, avg_size, max_size, hash_chunks=True):
+        """
+        Args:
+            min_size: Minimum chunk size.
+            avg_size: Target average chunk size; must be a power of two.
+            max_size: Maximum chunk size.
+            hash_chunks: Whether to hash the chunks.
+
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length() - 1, 1)
+        self._pattern = b'\x01' + b'\x00' * (bits - 1)
+        self.chunks = []
+        self._hasher = hashlib.sha256() if hash_chunks else None
+        self._offset = 0  # Bytes given so far
+        self._length = 0  # Bytes given since the last boundary
+        # Mapped bits of the last bytes, for matches spanning update() calls.
+        self._tail = b''
+
+    def update(self, data):
+        """Process the next data and return list of the boundaries found.
+
+        Boundaries are end offsets of chunks in all of the data.
+
+        """
+        symbols = bytes(data).translate(_BITS)
+        buf = self._tail + symbols
+        shift = len(self._tail)
+        pattern = self._pattern
+        size = len(symbols)
+        boundaries = []
+        pos = 0
+        while pos < size:
+            low = pos + max(self.min_size - self._length, 1)
+            high = pos + self.max_size - self._length
+            limit = min(high, size)
+            end = None
+            if low <= limit:
+                index = buf.find(pattern, max(low - len(pattern) + shift, 0),
+                                 limit + shift)
+                if index >= 0:
+                    end = index + len(pattern) - shift
+            if end is None and high <= size:
+                end = high
+            if end is None:
+                self._add(data[pos:])
+                break
+            self._add(data[pos:end])
+            self._cut()
+            boundaries.append(self._offset)
+            pos = end
+        self._tail = buf[-(len(pattern) - 1):] if len(pattern) > 1 else b''
+        return boundaries
+
+    def finish(self):
+        """End the data and return list of the boundaries found."""
+        if not self._length:
+            return []
+        self._cut()
+        return [self._offset]
+
+    def _add(self, data):
+        self._offset += len(data)
+        self._length += len(data)
+        if self._hasher is not None:
+            self._hasher.update(data)
+
+    def _cut(self):
+        if self._hasher is not None:
+            self.chunks.append([self._hasher.hexdigest(), self._length])
+            self._hasher = hashlib.sha256()
+        self._length = 0
+
+
+def chunk_boundaries(data, min_size, avg_size, max_size):
+    """Yield end offsets of the content defined chunks of data.
+
+    Args:
+        data: Bytes-like object.
+        min_size: Minimum chunk size.
+        avg_size: Target average chunk size; must be a power of two.
+        max_size: Maximum chunk size.
+
+    """
+    chunker = Chunker(min_size, avg_size, max_size, hash_chunks=False)
+    data = memoryview(data)
+    for start in range(0, len(data), _READ_LENGTH):
+        yield from chunker.update(data[start:start + _READ_LENGTH])
+    yield from chunker.finish()
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """Copy data from src_fd at offset to dst_fd, in the kernel if possible."""
+    while length:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, length, offset)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                 errno.EOPNOTSUPP):
+                raise
+            data = os.pread(src_fd, min(length, _READ_LENGTH), offset)
+            copied = os.write(dst_fd, data) if data else 0
+        if not copied:
+            raise EOFError('File is shorter than its chunks')
+        offset += copied
+        length -= copied
+
+
+class ChunkStore:
+
+    """Storage for content defined chunks."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, chunks_dir, staging_dir, cache_size=64,
+                 min_size=2 ** 18, avg_size=2 ** 20, max_size=2 ** 23):
+        """
+        Args:
+            chunks_dir: Directory to store chunks in.
+            staging_dir: Directory for files being written, on the same file
+                system as chunks_dir.
+            cache_size: Number of chunks kept in memory for reading.
+            min_size: Minimum chunk size.
+            avg_size: Target average chunk size; must be a power of two.
+            max_size: Maximum chunk size.
+
+        """
+        self.chunks_dir = chunks_dir
+        self._staging_dir = staging_dir
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.cache = LRUCache(cache_size)
+        self._manifests = LRUCache(cache_size * 16)
+
+    def chunk_path(self, digest):
+        """Return path of the chunk with the given hash."""
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def chunker(self):
+        """Return Chunker for finding chunks with this store's sizes."""
+        return Chunker(self.min_size, self.avg_size, self.max_size)
+
+    def _put_chunk(self, fd, offset, length, digest):
+        """Store a chunk copied from a file if it isn't stored."""
+        path = self.chunk_path(digest)
+        try:
+            # Touch shared chunks so garbage collection sees them as new.
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        else:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=self._staging_dir)
+        try:
+            try:
+                _copy_range(fd, tmp_fd, offset, length)
+            finally:
+                os.close(tmp_fd)
+            os.rename(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def store_chunks(self, path, chunks):
+        """Store the chunks of the file at path and write its manifest.
+
+        Args:
+            path: Path of the file.
+            chunks: The chunks attribute of a Chunker given all of the
+                file's data.
+
+        Returns:
+            Path of the manifest, a temporary file in the staging directory.
+
+        """
+        with open(path, 'rb') as file:
+            offset = 0
+            for digest, length in chunks:
+                self._put_chunk(file.fileno(), offset, length, digest)
+                offset += length
+        fd, tmp_path = tempfile.mkstemp(dir=self._staging_dir)
+        with open(fd, 'w') as file:
+            json.dump({'size': offset, 'chunks': chunks}, file)
+        return tmp_path
+
+    def write_manifest(self, path):
+        """Store the chunks of the file at path and write its manifest.
+
+        The file is read to find its chunks; use store_chunks() if they
+        were found while the file was written.
+
+        Returns:
+            Path of the manifest, a temporary file in the staging directory.
+
+        """
+        chunker = self.chunker()
+        with open(path, 'rb') as file:
+            for data in iter(lambda: file.read(_READ_LENGTH), b''):
+                chunker.update(data)
+        chunker.finish()
+        return self.store_chunks(path, chunker.chunks)
+
+    def manifest(self, path):
+        """Return Manifest loaded from the manifest file at path."""
+        manifest = self._manifests.get(path)
+        if manifest is None:
+            with open(path) as file:
+                raw = json.load(file)
+            hashes = [digest for digest, _ in raw['chunks']]
+            lengths = [length for _, length in raw['chunks']]
+            offsets = []
+            offset = 0
+            for length in lengths:
+                offsets.append(offset)
+                offset += length
+            manifest = Manifest(raw['size'], hashes, lengths, offsets)
+            self._manifests.put(path, manifest)
+        return manifest
+
+    def read_chunk(self, digest):
+        """Return the data of a chunk, using the cache."""
+        data = self.cache.get(digest)
+        if data is None:
+            with open(self.chunk_path(digest), 'rb') as file:
+                data = file.read()
+            self.cache.put(digest, data)
+        return data
+
+    def read(self, manifest, off, size):
+        """Read size bytes at offset off of a chunked file."""
+        end = min(off + size, manifest.size)
+        if off >= end:
+            return b''
+        index = bisect.bisect_right(manifest.offsets, off) - 1
+        parts = []
+        while off < end:
+            start = manifest.offsets[index]
+            data = memoryview(self.read_chunk(manifest.hashes[index]))
+            parts.append(data[off - start:end - start])
+            off = start + manifest.lengths[index]
+            index += 1
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def iter_data(self, manifest):
+        """Yield the data of a chunked file chunk by chunk, bypassing the
+        cache.
+
+        """
+        for digest in manifest.hashes:
+            with open(self.chunk_path(digest), 'rb') as file:
+                yield file.read()
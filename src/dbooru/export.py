@@ -0,0 +1,150 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.export
+
+This module implements streaming tar exports of stored files.
+
+A TarLayout describes a tar archive of stored files without writing it.
+The offset of every member is computed up front from the files' sizes, so
+any range of the archive can be read directly: headers are generated when
+read and member data is read from storage.  The archive is in GNU format,
+so members of any size fit in a single header block.
+
+"""
+
+import bisect
+import tarfile
+
+from dbooru import query
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+# Member names longer than this need extra header blocks.
+_NAME_LENGTH = 100
+
+
+def _padded(size, block=BLOCKSIZE):
+    """Return size rounded up to a whole number of blocks."""
+    return -(-size // block) * block
+
+
+class TarLayout:
+
+    """Layout of a tar archive of read only regular files.
+
+    The archive ends with two zero blocks and is padded to a whole record,
+    like archives written by tarfile.
+
+    """
+
+    def __init__(self, members):
+        """
+        Args:
+            members: Iterable of tuples of member name, size and
+                modification time, in archive order.  Names must be at most
+                100 bytes when encoded.
+
+        Raises:
+            ValueError: A member name is too long.
+
+        """
+        self.names = []
+        self.sizes = []
+        self.mtimes = []
+        self.starts = []  # Offsets of member headers
+        offset = 0
+        for name, size, mtime in members:
+            if len(name.encode()) > _NAME_LENGTH:
+                raise ValueError('Member name too long: {}'.format(name))
+            self.names.append(name)
+            self.sizes.append(size)
+            self.mtimes.append(int(mtime))
+            self.starts.append(offset)
+            offset += BLOCKSIZE + _padded(size)
+        self.data_size = offset
+        self.size = _padded(offset + 2 * BLOCKSIZE, tarfile.RECORDSIZE)
+        self._last_header = (None, None)
+
+    def header(self, index):
+        """Return the header block of a member."""
+        if self._last_header[0] == index:
+            return self._last_header[1]
+        info = tarfile.TarInfo(self.names[index])
+        info.size = self.sizes[index]
+        info.mtime = self.mtimes[index]
+        info.mode = 0o444
+        header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+        self._last_header = (index, header)
+        return header
+
+    def read(self, off, size, read_member):
+        """Read size bytes at offset off of the archive.
+
+        Args:
+            off: Offset in the archive.
+            size: Number of bytes to read.
+            read_member: Function called with a member index, an offset and
+                a size, returning that many bytes of the member's data.
+
+        """
+        end = min(off + size, self.size)
+        parts = []
+        while off < end:
+            if off >= self.data_size:
+                parts.append(bytes(end - off))
+                break
+            index = bisect.bisect_right(self.starts, off) - 1
+            pos = off - self.starts[index]
+            if pos < BLOCKSIZE:
+                data = self.header(index)[pos:pos + end - off]
+            elif pos - BLOCKSIZE < self.sizes[index]:
+                data_off = pos - BLOCKSIZE
+                length = min(end - off, self.sizes[index] - data_off)
+                data = read_member(index, data_off, length)
+                if len(data) != length:
+                    raise EOFError('Member {} is shorter than recorded'
+                                   .format(self.names[index]))
+            else:
+                member_end = (self.starts[index] + BLOCKSIZE
+                              + _padded(self.sizes[index]))
+                data = bytes(min(end, member_end) - off)
+            parts.append(data)
+            off += len(data)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+
+def tar_layout(backend, text):
+    """Return TarLayout of the stored files matching a query.
+
+    Members are named by fid and sorted.  Files deleted since they were
+    recorded are left out.
+
+    Args:
+        backend: DbooruBackend instance.
+        text: Query text or query tree.
+
+    """
+    members = []
+    for fid in sorted(query.search(backend, text)):
+        try:
+            st = backend.stat(fid)
+        except FileNotFoundError:
+            continue
+        members.append((fid, st.st_size, st.st_mtime))
+    return TarLayout(members)
@@ -21,7 +21,8 @@ This module defines the FUSE operations used by dbooru.
 
 """
 
-from collections import namedtuple
+import errno
+import json
 import os
 
 import llfuse
@@ -29,65 +30,96 @@ import llfuse
 from dbooru.oslib import do_os
 from dbooru.backend import DbooruBackend
 from dbooru.handlers.root import RootInodeHandler
+from dbooru.inodes import InodeAllocator
+from dbooru.stats import Stats
+from dbooru.stats import timed
+from dbooru.tables import HandleTable
+from dbooru.tables import InodeTable
 
-FileTabEntry = namedtuple('FileTabEntry', ['handler', 'count'])
-InoTabEntry = namedtuple('InoTabEntry', ['handler', 'count'])
 
+class FUSEOp(llfuse.Operations):
+    """dbooru implementation of FUSE operations.
 
-class _HandleGen:
-
-    """File handle generator."""
-
-    _LIMIT = 2
-
-    def __init__(self):
-        self._head = self._LIMIT
-        self._unused = []
-
-    def __next__(self):
-        if self._unused:
-            return self._unused.pop()
-        else:
-            self._head += 1
-            return self._head
-
-    def forget(self, fh):
-        if fh > self._head or fh <= self._LIMIT:
-            raise ValueError('{} not issued.'.format(fh))
-        elif fh in self._unused:
-            raise ValueError('{} already forgotten.'.format(fh))
-        self._unused.append(fh)
+    Latencies of all operations are recorded in the stats attribute, and
+    are exposed with other statistics in the .stats file at the mount root.
 
+    """
 
-class FUSEOp(llfuse.Operations):
-    """dbooru implementation of FUSE operations."""
+    # Seconds the kernel may cache failed lookups.
+    NEGATIVE_TIMEOUT = 5
 
     ###########################################################################
     # Set up
-    def __init__(self, root):
-        """Initialize handler."""
+    def __init__(self, root, stats_file=None,
+                 negative_timeout=NEGATIVE_TIMEOUT):
+        """Initialize handler.
+
+        Args:
+            root: Path to dbooru directory.
+            stats_file: Path to write statistics to as JSON on destroy().
+            negative_timeout: Seconds the kernel may cache that a name
+                doesn't exist.  Files added by other processes may be hidden
+                for this long.  If 0, failed lookups aren't cached.
+
+        """
         super().__init__()
         self._root = root
+        self._negative_timeout = negative_timeout
         self._backend = DbooruBackend(root)
         self._fh_table = None
         self._ino_table = None
-        self._fh_gen = None
+        self._inodes = None
+        self._stats_file = stats_file
+        self.stats = Stats()
 
     def init(self):
         """Set up."""
-        self._fh_table = {}
-        # ROOT_INODE isn't detected
-        # pylint: disable=no-member
-        self._ino_table = {
-            llfuse.ROOT_INODE: InoTabEntry(RootInodeHandler(self._root), 1),
-        }
-        self._fh_gen = _HandleGen()
+        self._fh_table = HandleTable()
+        self._backend.recover()
+        self._backend.open_snapshot()
+        # Virtual inode numbers are assigned per mount, so every mount needs
+        # a new generation number.
+        mounts = int(self._backend.get_meta('mounts', 0)) + 1
+        self._backend.set_meta('mounts', mounts)
+        self._inodes = InodeAllocator(self._backend, generation=mounts)
+        root_handler = RootInodeHandler(
+            self._root, self._backend, self._inodes, stats=self.snapshot)
+        self._ino_table = InodeTable()
+        self._ino_table.incref(root_handler)
 
     def destroy(self):
         """Tear down."""
+        if self._stats_file is not None:
+            with open(self._stats_file, 'w') as file:
+                json.dump(self.snapshot(), file, indent=2, sort_keys=True)
+        # Lets the next mount start quickly.
+        self._backend.write_snapshot()
+        self._backend.close()
+
+    def table_stats(self):
+        """Return dict of file handle and inode table statistics."""
+        return {
+            'handles': self._fh_table.stats(),
+            'inodes': self._ino_table.stats(),
+        }
+
+    def snapshot(self):
+        """Return JSON serializable dict of all statistics."""
+        # pylint: disable=no-member
+        caches = self._backend.cache_stats()
+        caches['tag_results'] = (
+            self._ino_table[llfuse.ROOT_INODE].result_cache.stats())
+        caches['virtual_inodes'] = self._inodes.stats()
+        return {
+            'operations': self.stats.to_dict(),
+            'backend': self._backend.stats.to_dict(),
+            'caches': caches,
+            'tables': self.table_stats(),
+        }
 
     ###########################################################################
     # General handlers
+    @timed
     def statfs(self):
         return do_os(os.statvfs, self._root)
 
@@ -95,11 +127,13 @@ class FUSEOp(llfuse.Operations):
     # File handlers
     def _get_fh(self, fh):
         """Return handler for given file handle."""
-        return self._fh_table[fh].handler
+        return self._fh_table[fh]
 
+    @timed
     def write(self, fh, off, buf):
         return self._get_fh(fh).write(off, buf)
 
+    @timed
     def flush(self, fh):
         """Called on close()
 
@@ -109,18 +143,23 @@ class FUSEOp(llfuse.Operations):
         """
         self._get_fh(fh).flush()
 
+    @timed
     def fsync(self, fh, datasync):
         self._get_fh(fh).fsync(datasync)
 
+    @timed
     def fsyncdir(self, fh, datasync):
         self._get_fh(fh).fsyncdir(datasync)
 
+    @timed
     def read(self, fh, off, size):
         return self._get_fh(fh).read(off, size)
 
+    @timed
     def readdir(self, fh, off):
         return self._get_fh(fh).readdir(off)
 
+    @timed
     def release(self, fh):
         """Finally close fh.
 
@@ -130,110 +169,133 @@ class FUSEOp(llfuse.Operations):
         self._release_with_func(
             fh, self._get_fh(fh).release)
 
+    @timed
     def releasedir(self, fh):
         self._release_with_func(
             fh, self._get_fh(fh).releasedir)
 
     def _release_with_func(self, fh, func):
         """Decrement fh count and call function when zero."""
-        entry = self._fh_table[fh]
-        count = entry.count - 1
-        if count < 1:
+        if self._fh_table.decref(fh) < 1:
             func()
-            del self._fh_table[fh]
-            self._fh_gen.forget(fh)
-        else:
-            self._fh_table[fh] = entry._replace(count=count)
+            self._fh_table.remove(fh)
 
     ###########################################################################
     # General inode handlers
+    @timed
     def forget(self, inode_list):
         for inode, nlookup in inode_list:
-            entry = self._ino_table[inode]
-            count = entry.count - nlookup
-            if count < 1:
-                del self._ino_table[inode]
-            else:
-                self._ino_table[inode] = entry._replace(count=count)
+            self._ino_table.decref(inode, nlookup)
 
     ###########################################################################
     # Inode handlers
     def _get_ino(self, inode):
         """Get handler for inode."""
-        return self._ino_table[inode].handler
+        return self._ino_table[inode]
 
     def _set_ino(self, handler):
-        """Set handler in inode table."""
-        self._ino_table[handler.attr.st_ino] = handler
+        """Set handler in inode table, incrementing its lookup count."""
+        self._ino_table.incref(handler)
 
     def _set_fh(self, handler):
         """Set handler in file handle table."""
-        fh = next(self._fh_gen)
-        self._fh_table[fh] = handler
-        return fh
+        return self._fh_table.add(handler)
 
+    @timed
     def access(self, inode, mode, ctx):
         return self._get_ino(inode).access(mode, ctx)
 
+    @timed
     def create(self, inode_parent, name, mode, flags, ctx):
         return self._get_ino(inode_parent).create(
             name, mode, flags, ctx)
 
+    @timed
     def getattr(self, inode):
         return self._get_ino(inode).getattr()
 
+    @timed
     def getxattr(self, inode, name):
         return self._get_ino(inode).getxattr(name)
 
+    @timed
     def link(self, inode, new_parent_inode, new_name):
         return self._get_ino(inode).link(new_parent_inode, new_name)
 
+    @timed
     def listxattr(self, inode):
         return self._get_ino(inode).listxattr()
 
+    @timed
     def lookup(self, parent_inode, name):
-        handler = self._get_ino(parent_inode).lookup(name)
+        try:
+            handler = self._get_ino(parent_inode).lookup(name)
+        except llfuse.FUSEError as err:
+            if err.errno != errno.ENOENT or not self._negative_timeout:
+                raise
+            return self._negative_entry()
         self._set_ino(handler)
         return handler.attr
 
+    def _negative_entry(self):
+        """Return EntryAttributes for a cacheable failed lookup."""
+        # pylint: disable=no-member
+        attr = llfuse.EntryAttributes()
+        attr.st_ino = 0
+        attr.entry_timeout = self._negative_timeout
+        attr.attr_timeout = 0
+        return attr
+
+    @timed
     def mkdir(self, parent_inode, name, mode, ctx):
         return self._get_ino(parent_inode).mkdir(name, mode, ctx)
 
+    @timed
     def mknod(self, parent_inode, name, mode, rdev, ctx):
         return self._get_ino(parent_inode).mknod(
             name, mode, rdev, ctx)
 
+    @timed
     def open(self, inode, flags):
         handler = self._get_ino(inode).open(flags)
         fh = self._set_fh(handler)
         return fh
 
+    @timed
     def opendir(self, inode):
         handler = self._get_ino(inode).opendir()
         fh = self._set_fh(handler)
         return fh
 
+    @timed
     def readlink(self, inode):
         return self._get_ino(inode).readlink()
 
+    @timed
     def removexattr(self, inode, name):
         self._get_ino(inode).removexattr(name)
 
+    @timed
     def rename(self, inode_parent_old, name_old, inode_parent_new, name_new):
         self._get_ino(inode_parent_old).rename(
             name_old, inode_parent_new, name_new)
 
+    @timed
     def rmdir(self, inode_parent, name):
         self._get_ino(inode_parent).rmdir(name)
 
+    @timed
     def setattr(self, inode, attr):
         self._get_ino(inode).setattr(attr)
 
+    @timed
     def setxattr(self, inode, name, value):
         self._get_ino(inode).setxattr(name, value)
 
+    @timed
     def symlink(self, inode_parent, name, target, ctx):
         return self._get_ino(inode_parent).symlink(name, target, ctx)
 
+    @timed
     def unlink(self, parent_inode, name):
         return self._get_ino(parent_inode).unlink(name)
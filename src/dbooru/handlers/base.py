@@ -22,10 +22,141 @@ behavior.
 
 """
 
+from collections import namedtuple
 import errno
+import os
+import stat
+import time
 
 import llfuse
 
+from dbooru.cache import LRUCache
+from dbooru.oslib import unlocked
+
+# Seconds the kernel may cache attributes of virtual files.
+DEFAULT_TIMEOUT = 300
+
+
+def make_attr(inode, mode, size=0, nlink=1, timeout=DEFAULT_TIMEOUT,
+              generation=0):
+    """Make EntryAttributes for a virtual file."""
+    now = time.time()
+    attr = llfuse.EntryAttributes()
+    attr.st_ino = inode
+    attr.generation = generation  # used if inodes change after restart
+    attr.entry_timeout = timeout
+    attr.attr_timeout = timeout
+    attr.st_mode = mode
+    attr.st_nlink = nlink
+    attr.st_uid = os.getuid()
+    attr.st_gid = os.getgid()
+    attr.st_rdev = 0
+    attr.st_size = size
+    attr.st_blksize = 4096
+    attr.st_blocks = (size + 511) // 512
+    attr.st_atime = now
+    attr.st_ctime = now
+    attr.st_mtime = now
+    return attr
+
+
+def stat_attr(inode, st, timeout=DEFAULT_TIMEOUT, generation=0):
+    """Make EntryAttributes for a file from its stat structure."""
+    attr = llfuse.EntryAttributes()
+    attr.st_ino = inode
+    attr.generation = generation
+    attr.entry_timeout = timeout
+    attr.attr_timeout = timeout
+    attr.st_mode = st.st_mode
+    attr.st_nlink = st.st_nlink
+    attr.st_uid = st.st_uid
+    attr.st_gid = st.st_gid
+    attr.st_rdev = st.st_rdev
+    attr.st_size = st.st_size
+    attr.st_blksize = st.st_blksize
+    attr.st_blocks = st.st_blocks
+    attr.st_atime = st.st_atime
+    attr.st_ctime = st.st_ctime
+    attr.st_mtime = st.st_mtime
+    return attr
+
+
+def dirent_attr(inode, mode):
+    """Make minimal EntryAttributes for a readdir entry.
+
+    The kernel only uses the inode number and file type of readdir entries,
+    so this avoids a stat call per entry.
+
+    """
+    attr = llfuse.EntryAttributes()
+    attr.st_ino = inode
+    attr.st_mode = mode
+    return attr
+
+
+DIR_MODE = stat.S_IFDIR | 0o555
+FILE_MODE = stat.S_IFREG | 0o444
+
+_CacheEntry = namedtuple('_CacheEntry', ['version', 'time', 'value'])
+
+
+class ResultCache:
+
+    """LRU cache of values computed from the database, such as listings.
+
+    Entries are invalidated when the backend's version changes, and expire
+    after max_age seconds so that changes made by other processes are
+    eventually noticed.
+
+    """
+
+    def __init__(self, backend, timer, size=256, max_age=60):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            timer: Name of the backend stats timer for computing values.
+            size: Number of values to cache.
+            max_age: Seconds to cache values.
+
+        """
+        self._backend = backend
+        self._timer = timer
+        self._max_age = max_age
+        self._entries = LRUCache(size)
+
+    def get(self, key, func):
+        """Return value for key, calling func to make it if needed.
+
+        func is called with the llfuse global lock released.
+
+        """
+        version = self._backend.version
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if (entry is not None and entry.version == version
+                and now - entry.time < self._max_age):
+            return entry.value
+        with self._backend.stats.timer(self._timer):
+            value = unlocked(func)
+        self._entries.put(key, _CacheEntry(version, now, value))
+        return value
+
+    def peek(self, key):
+        """Return current cached value for key, or None."""
+        entry = self._entries.get(key)
+        if (entry is not None and entry.version == self._backend.version
+                and time.monotonic() - entry.time < self._max_age):
+            return entry.value
+        return None
+
+    def clear(self):
+        """Drop all cached values."""
+        self._entries.clear()
+
+    def stats(self):
+        """Return dict of cache statistics."""
+        return self._entries.stats()
+
 
 class BaseFileHandler:
 
@@ -117,7 +248,7 @@ class BaseInodeHandler:
     def setattr(self, attr):
         raise llfuse.FUSEError(errno.ENOSYS)
 
-    def setxattr(self, inode, name, value):
+    def setxattr(self, name, value):
         raise llfuse.FUSEError(errno.ENOSYS)
 
     def symlink(self, name, target, ctx):
@@ -138,7 +269,12 @@ class BaseFile:
 
 class BaseDir(BaseFile):
 
-    """Base class for virtual directories."""
+    """Base class for virtual directories.
+
+    Virtual directories act as their own directory handle, so opendir()
+    returns the directory itself.
+
+    """
 
     def __init__(self, *args, parent=None, **kwargs):
         self._parent = parent
@@ -148,21 +284,108 @@ class BaseDir(BaseFile):
     def parent_attr(self):
         return self._parent.attr
 
+    def getattr(self):
+        return self.attr
+
+    def access(self, mode, ctx):
+        return True
+
+    def opendir(self):
+        return self
+
+    def releasedir(self):
+        pass
+
 
 class BaseLookupDir(BaseDir):
 
-    """Base class that implements basic virtual inode lookup."""
+    """Base class that implements basic virtual inode lookup.
+
+    lookup_map maps entry names (bytes) to inode handlers.
+
+    """
 
     def __init__(self, *args, lookup_map, **kwargs):
         self._lookup_map = lookup_map
         super().__init__(*args, **kwargs)
 
     def lookup(self, name):
-        if name == '.':
-            return self.attr
-        elif name == '..':
-            return self.parent_attr
+        if name == b'.':
+            return self
+        elif name == b'..':
+            return self._parent if self._parent is not None else self
         elif name in self._lookup_map:
             return self._lookup_map[name]
         else:
-            return super().lookup(name)
+            raise llfuse.FUSEError(errno.ENOENT)
+
+    def readdir(self, off):
+        entries = sorted(self._lookup_map.items())
+        for i, (name, handler) in enumerate(entries[off:], off + 1):
+            yield (name, handler.attr, i)
+
+
+class BaseRenderedFile(BaseFile, BaseInodeHandler):
+
+    """Base class for read only virtual files with generated contents.
+
+    Subclasses implement _render_bytes().  The contents are rendered when
+    the file's attributes are requested, so the reported size matches what
+    is read after opening it.  Files too large to hold in memory override
+    _render() and _handler() instead.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._contents = None
+        super().__init__(*args, **kwargs)
+
+    def _render_bytes(self):
+        """Return the current contents of the file."""
+        raise NotImplementedError
+
+    def _render(self):
+        """Render the file, update its size and return its contents."""
+        data = self._render_bytes()
+        self._set_size(len(data))
+        return data
+
+    def _set_size(self, size):
+        self.attr.st_size = size
+        self.attr.st_blocks = (size + 511) // 512
+
+    def _handler(self, contents):
+        """Return file handler reading contents returned by _render()."""
+        # pylint: disable=no-self-use
+        return BufferFileHandler(contents)
+
+    def getattr(self):
+        self._contents = self._render()
+        return self.attr
+
+    def access(self, mode, ctx):
+        return not mode & os.W_OK
+
+    def open(self, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise llfuse.FUSEError(errno.EROFS)
+        if self._contents is None:
+            self._contents = self._render()
+        return self._handler(self._contents)
+
+
+class BufferFileHandler(BaseFileHandler):
+
+    """File handler reading from a bytes object."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def read(self, off, size):
+        return self._data[off:off + size]
+
+    def flush(self):
+        pass
+
+    def release(self):
+        pass
@@ -0,0 +1,123 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.handlers.complete
+
+This module contains the virtual directory for completing tags.
+
+Every name looked up in the complete directory is a read only file listing
+the tags starting with that name, one per line with the number of files
+having the tag, separated by a tab.  Names containing = complete the values
+of a key.  For example, /complete/ca lists keys such as cat and car, and
+/complete/rating=s lists tags such as rating=safe.  Names with no
+completions don't exist.  The directory itself lists no entries.
+
+"""
+
+import errno
+import os
+import re
+
+import llfuse
+
+from dbooru.oslib import do_os
+from dbooru.oslib import unlocked
+
+from .base import BaseFileHandler
+from .base import BaseInodeHandler
+from .base import BaseLookupDir
+from .base import BaseRenderedFile
+from .base import DIR_MODE
+from .base import FILE_MODE
+from .base import make_attr
+
+# Values that must be quoted in query expressions; see dbooru.query.
+_QUOTE_RE = re.compile(r'[\s()]')
+
+
+class CompleteInodeHandler(BaseLookupDir, BaseInodeHandler, BaseFileHandler):
+
+    """Virtual directory of tag completions."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, backend, inodes, limit=1000, parent=None):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            inodes: InodeAllocator instance.
+            limit: Maximum number of completions in a file.
+            parent: Parent directory handler.
+
+        """
+        self._backend = backend
+        self._inodes = inodes
+        self._limit = limit
+        attr = make_attr(inodes.get('complete'), DIR_MODE,
+                         generation=inodes.generation)
+        super().__init__(attr=attr, parent=parent, lookup_map={})
+
+    def lookup(self, name):
+        if name in (b'.', b'..'):
+            return super().lookup(name)
+        text = os.fsdecode(name)
+        # Checked before making a handler, so that failed lookups don't
+        # allocate inode numbers.
+        if not unlocked(_completions, self._backend, text, 1):
+            raise llfuse.FUSEError(errno.ENOENT)
+        return CompletionInodeHandler(
+            self._backend, self._inodes, text, self._limit)
+
+
+class CompletionInodeHandler(BaseRenderedFile):
+
+    """Read only file listing completions of a tag prefix."""
+
+    def __init__(self, backend, inodes, text, limit):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            inodes: InodeAllocator instance.
+            text: Prefix to complete.
+            limit: Maximum number of completions.
+
+        """
+        self._backend = backend
+        self._text = text
+        self._limit = limit
+        attr = make_attr(inodes.get(('complete', text)), FILE_MODE,
+                         timeout=0, generation=inodes.generation)
+        super().__init__(attr=attr)
+
+    def _render_bytes(self):
+        completions = do_os(unlocked, _completions, self._backend,
+                            self._text, self._limit)
+        return ''.join('{}\t{:d}\n'.format(text, count)
+                       for text, count in completions).encode()
+
+
+def _completions(backend, text, limit):
+    """Return list of pairs of completed tag text and count."""
+    key, sep, prefix = text.partition('=')
+    if not sep:
+        return backend.tags(key, limit)
+    completions = []
+    for val, count in backend.tag_values(key, prefix, limit):
+        if _QUOTE_RE.search(val):
+            val = '"' + val + '"'
+        completions.append((key + '=' + val, count))
+    return completions
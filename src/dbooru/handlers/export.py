@@ -0,0 +1,201 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.handlers.export
+
+This module contains the virtual directory for exporting query results.
+
+Every name ending in .tar looked up in the export directory is a read only
+tar archive of the files matching the rest of the name as a query
+expression (see dbooru.query), named by fid.  For example,
+/export/rating=safe.tar is an archive of the files with rating safe.
+Archives are generated while they are read, straight from storage, and
+can be read at any offset.  The directory itself lists no entries.
+
+"""
+
+import errno
+import functools
+import os
+import threading
+
+import llfuse
+
+from dbooru import query
+from dbooru.export import tar_layout
+from dbooru.oslib import do_os
+from dbooru.oslib import unlocked
+
+from .base import BaseFileHandler
+from .base import BaseInodeHandler
+from .base import BaseLookupDir
+from .base import BaseRenderedFile
+from .base import DIR_MODE
+from .base import FILE_MODE
+from .base import ResultCache
+from .base import make_attr
+
+_SUFFIX = b'.tar'
+
+
+class ExportInodeHandler(BaseLookupDir, BaseInodeHandler, BaseFileHandler):
+
+    """Virtual directory of query result archives.
+
+    Archive layouts are cached until the backend's version changes, or for
+    max_age seconds so that changes made by other processes are eventually
+    noticed.
+
+    """
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, backend, inodes, size=16, max_age=60, parent=None):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            inodes: InodeAllocator instance.
+            size: Number of archive layouts to cache.
+            max_age: Seconds to cache archive layouts.
+            parent: Parent directory handler.
+
+        """
+        self._backend = backend
+        self._inodes = inodes
+        self._layouts = ResultCache(backend, 'export.layout', size, max_age)
+        attr = make_attr(inodes.get('export'), DIR_MODE,
+                         generation=inodes.generation)
+        super().__init__(attr=attr, parent=parent, lookup_map={})
+
+    def lookup(self, name):
+        if name in (b'.', b'..'):
+            return super().lookup(name)
+        if not name.endswith(_SUFFIX):
+            raise llfuse.FUSEError(errno.ENOENT)
+        text = os.fsdecode(name[:-len(_SUFFIX)])
+        try:
+            tree = query.parse(text)
+        except query.QuerySyntaxError:
+            raise llfuse.FUSEError(errno.ENOENT)
+        # Checked before making a handler, so that failed lookups don't
+        # allocate inode numbers.
+        if not self.layout(text, tree).names:
+            raise llfuse.FUSEError(errno.ENOENT)
+        handler = ArchiveInodeHandler(
+            self._backend, self._inodes, text,
+            functools.partial(self.layout, text, tree))
+        handler.getattr()
+        return handler
+
+    def layout(self, text, tree):
+        """Return TarLayout for query text, making it if needed."""
+        return self._layouts.get(
+            text, functools.partial(do_os, tar_layout, self._backend, tree))
+
+
+class ArchiveInodeHandler(BaseRenderedFile):
+
+    """Read only tar archive of the files matching a query.
+
+    Archives aren't held in memory; rendering one makes its layout.  Each
+    open handle reads the layout current when the archive was last
+    rendered, so the archive read is consistent even if files are added
+    meanwhile.
+
+    """
+
+    def __init__(self, backend, inodes, text, layout):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            inodes: InodeAllocator instance.
+            text: Query text.
+            layout: Callable returning the archive's current TarLayout.
+
+        """
+        self._backend = backend
+        self._layout = layout
+        attr = make_attr(inodes.get(('export', text)), FILE_MODE,
+                         timeout=0, generation=inodes.generation)
+        super().__init__(attr=attr)
+
+    def _render(self):
+        layout = self._layout()
+        self._set_size(layout.size)
+        return layout
+
+    def _handler(self, contents):
+        return ArchiveFileHandler(self._backend, contents)
+
+
+class ArchiveFileHandler(BaseFileHandler):
+
+    """File handler reading a tar archive of stored files.
+
+    The stored file being read is kept open between reads, since archives
+    are usually read sequentially.
+
+    """
+
+    def __init__(self, backend, layout):
+        self._backend = backend
+        self._layout = layout
+        self._lock = threading.Lock()
+        self._index = None  # Index of the open member
+        self._fd = None
+        self._manifest = None
+
+    def read(self, off, size):
+        try:
+            return do_os(unlocked, self._read, off, size)
+        except EOFError:
+            raise llfuse.FUSEError(errno.EIO)
+
+    def _read(self, off, size):
+        # Only taken with the llfuse global lock released, so that waiting
+        # for another read doesn't block the whole file system.
+        with self._lock:
+            return self._layout.read(off, size, self._read_member)
+
+    def _read_member(self, index, off, size):
+        if index != self._index:
+            self._close_member()
+            fid = self._layout.names[index]
+            if self._backend.is_chunked(fid):
+                self._manifest = self._backend.chunk_store.manifest(
+                    self._backend.manifest_path(fid))
+            else:
+                self._fd = os.open(self._backend.fid_path(fid), os.O_RDONLY)
+            self._index = index
+        if self._manifest is not None:
+            return self._backend.chunk_store.read(self._manifest, off, size)
+        return os.pread(self._fd, size, off)
+
+    def _close_member(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._index = self._fd = self._manifest = None
+
+    def flush(self):
+        pass
+
+    def release(self):
+        do_os(unlocked, self._close)
+
+    def _close(self):
+        with self._lock:
+            self._close_member()
@@ -22,48 +22,106 @@ native file system.
 
 """
 
+from collections import deque
+import itertools
 import os
-
-import llfuse
+import stat
 
 from dbooru.oslib import do_os
+from dbooru.oslib import unlocked
 
 from .base import BaseFileHandler, BaseInodeHandler
+from .base import dirent_attr
+
+
+def _dirent_attr(dir_entry):
+    """Return readdir entry attributes for an os.DirEntry."""
+    if dir_entry.is_symlink():
+        mode = stat.S_IFLNK
+    elif dir_entry.is_dir(follow_symlinks=False):
+        mode = stat.S_IFDIR
+    else:
+        mode = stat.S_IFREG
+    return dirent_attr(dir_entry.inode(), mode)
 
 
 class RawFileHandler(BaseFileHandler):
 
-    """File handling for actual files."""
+    """File handling for actual files.
+
+    Directories are listed with a single os.scandir() pass that is resumed
+    across readdir() calls, so listing a directory is linear in its size.
+    The scan is read a window of entries at a time, with the llfuse lock
+    released.  Inode numbers and file types come from the directory entries
+    themselves, so no stat calls are needed.  Only the most recently read
+    entries are kept, to serve the kernel re-requesting entries that didn't
+    fit in its buffer; seeking further back restarts the scan.
+
+    """
+
+    _WINDOW = 1024
 
     def __init__(self, fh):
         self.fh = fh
+        self._scan = None
+        self._pos = 0  # Number of entries read from _scan
+        self._recent = deque(maxlen=self._WINDOW)
 
     def write(self, off, buf):
-        return do_os(os.pwrite, self.fh, buf, off)
+        return do_os(unlocked, os.pwrite, self.fh, buf, off)
 
     def flush(self):
         pass
 
     def fsync(self, datasync):
         if datasync:
-            do_os(os.fdatasync, self.fh)
+            do_os(unlocked, os.fdatasync, self.fh)
         else:
-            do_os(os.fsync, self.fh)
+            do_os(unlocked, os.fsync, self.fh)
 
     fsyncdir = fsync
 
     def read(self, off, size):
-        return do_os(os.pread, self.fh, size, off)
+        return do_os(unlocked, os.pread, self.fh, size, off)
 
     def readdir(self, off):
-        names = do_os(llfuse.listdir, self.fh)  # pylint: disable=no-member
-        while off < len(names):
-            name = names[off]
-            off += 1
-            yield (name.encode(), do_os(os.stat, name, dir_fd=self.fh), off)
+        # The kernel doesn't read a directory handle concurrently, so the
+        # scan is read without a lock of its own.
+        if self._scan is None or off < self._pos - len(self._recent):
+            do_os(unlocked, self._rewind)
+            self._pos = 0
+            self._recent.clear()
+        while True:
+            if off < self._pos:
+                skip = off - (self._pos - len(self._recent))
+                recent = list(itertools.islice(self._recent, skip, None))
+                for i, entry in enumerate(recent, off + 1):
+                    yield entry + (i,)
+                off = self._pos
+            entries = do_os(unlocked, self._read_entries)
+            if not entries:
+                return
+            self._recent.extend(entries)
+            self._pos += len(entries)
+
+    def _rewind(self):
+        """Start scanning directory from the beginning."""
+        self._close_scan()
+        self._scan = os.scandir(self.fh)
+
+    def _close_scan(self):
+        if self._scan is not None:
+            self._scan.close()
+            self._scan = None
+
+    def _read_entries(self):
+        """Return list of up to _WINDOW entries read from the scan."""
+        return [(os.fsencode(dir_entry.name), _dirent_attr(dir_entry))
+                for dir_entry in itertools.islice(self._scan, self._WINDOW)]
 
     def release(self):
-        do_os(os.close, self.fh)
+        self._close_scan()
+        do_os(unlocked, os.close, self.fh)
 
     releasedir = release
 
@@ -123,7 +181,7 @@ class RawInodeHandler(BaseInodeHandler):
     def setattr(self, attr):
         raise NotImplementedError
 
-    def setxattr(self, inode, name, value):
+    def setxattr(self, name, value):
         raise NotImplementedError
 
     def symlink(self, name, target, ctx):
@@ -15,10 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
 
-"""dbooru.handlers.raw
+"""dbooru.handlers.root
 
-This module contains implementations for handling files and inodes using the
-native file system.
+This module contains the handler for the root directory of the mount.
 
 """
 
@@ -33,15 +32,43 @@ from dbooru.oslib import do_os
 from .base import BaseInodeHandler
 from .base import BaseFileHandler
 from .base import BaseLookupDir
-
-
-class RootInodeHandler(BaseFileHandler, BaseInodeHandler, BaseLookupDir):
-
-    def __init__(self, root):
+from .base import ResultCache
+from .complete import CompleteInodeHandler
+from .export import ExportInodeHandler
+from .stats import StatsInodeHandler
+from .stored import FilesInodeHandler
+from .tags import TagInodeHandler
+
+
+class RootInodeHandler(BaseLookupDir, BaseInodeHandler, BaseFileHandler):
+
+    def __init__(self, root, backend, inodes, stats=None):
+        """
+        Args:
+            root: Path to dbooru directory.
+            backend: DbooruBackend instance.
+            inodes: InodeAllocator instance.
+            stats: Callable returning statistics for the .stats file.  If
+                None, there is no .stats file.
+
+        """
         self._root = root
         attr = self._make_attr()
         lookup_map = {}
         super().__init__(attr=attr, lookup_map=lookup_map)
+        lookup_map[b'files'] = FilesInodeHandler(backend, inodes, parent=self)
+        self.result_cache = ResultCache(backend, 'tags.query')
+        lookup_map[b'tags'] = TagInodeHandler(
+            backend, inodes, self.result_cache, parent=self)
+        lookup_map[b'complete'] = CompleteInodeHandler(
+            backend, inodes, parent=self)
+        lookup_map[b'export'] = ExportInodeHandler(
+            backend, inodes, parent=self)
+        if stats is not None:
+            lookup_map[b'.stats'] = StatsInodeHandler(inodes, stats)
+        self.attr.st_nlink = 2 + sum(
+            1 for handler in lookup_map.values()
+            if stat.S_ISDIR(handler.attr.st_mode))
 
     def _make_attr(self):
         statvfs = do_os(os.statvfs, self._root)
@@ -53,8 +80,8 @@ class RootInodeHandler(BaseFileHandler, BaseInodeHandler, BaseLookupDir):
         attr.entry_timeout = 300
         attr.attr_timeout = 300
         attr.st_mode = 0o777 | stat.S_IFDIR
-        attr.st_nlink = 1  # Fix for subdirectories?
-        attr.st_uid = do_os(os.getpid)
+        attr.st_nlink = 2  # Updated for subdirectories in __init__.
+        attr.st_uid = do_os(os.getuid)
         attr.st_gid = do_os(os.getgid)
         attr.st_size = 4096
         attr.st_blksize = statvfs.f_bsize
@@ -72,33 +99,3 @@ class RootInodeHandler(BaseFileHandler, BaseInodeHandler, BaseLookupDir):
         # Everyone can access everything.  Maybe this should be limited to the
         # original user?
         return True
-
-    def getattr(self):
-        return self.attr
-
-    def opendir(self):
-        return self
-
-    def write(self, off, buf):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def flush(self):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def fsync(self, datasync):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def fsyncdir(self, datasync):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def read(self, off, size):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def readdir(self, off):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def release(self):
-        raise llfuse.FUSEError(errno.ENOSYS)
-
-    def releasedir(self):
-        raise llfuse.FUSEError(errno.ENOSYS)
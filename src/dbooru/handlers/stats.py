@@ -0,0 +1,49 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.handlers.stats
+
+This module contains the handler for the virtual statistics file.
+
+"""
+
+import json
+
+from .base import BaseRenderedFile
+from .base import FILE_MODE
+from .base import make_attr
+
+
+class StatsInodeHandler(BaseRenderedFile):
+
+    """Read only file containing statistics as JSON."""
+
+    def __init__(self, inodes, snapshot):
+        """
+        Args:
+            inodes: InodeAllocator instance.
+            snapshot: Callable returning a JSON serializable dict.
+
+        """
+        self._snapshot = snapshot
+        attr = make_attr(inodes.get('stats'), FILE_MODE, timeout=0,
+                         generation=inodes.generation)
+        super().__init__(attr=attr)
+
+    def _render_bytes(self):
+        return json.dumps(
+            self._snapshot(), indent=2, sort_keys=True).encode() + b'\n'
@@ -0,0 +1,267 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.handlers.stored
+
+This module contains the inode handlers for files in dbooru storage.
+
+"""
+
+import errno
+import os
+
+import llfuse
+
+from dbooru.oslib import do_os
+from dbooru.oslib import unlocked
+
+from .base import BaseDir
+from .base import BaseFile
+from .base import BaseFileHandler
+from .base import BaseInodeHandler
+from .base import DEFAULT_TIMEOUT
+from .base import DIR_MODE
+from .base import FILE_MODE
+from .base import dirent_attr
+from .base import make_attr
+from .base import stat_attr
+
+
+# Stored files are immutable, so the kernel can cache their attributes for
+# much longer than those of virtual files.
+ATTR_TIMEOUT = 24 * 60 * 60
+
+
+def _stored_attr(backend, fid, inode):
+    """Return EntryAttributes for a stored file, using the backend cache."""
+    attr = backend.attr_cache.get(fid)
+    if attr is None or attr.st_ino != inode:
+        attr = do_os(unlocked, _stat_stored, backend, fid, inode)
+        backend.attr_cache.put(fid, attr)
+    return attr
+
+
+def _stat_stored(backend, fid, inode):
+    """Return EntryAttributes for a stored file from its stat structure."""
+    # The generation is read from the database the first time.
+    attr = stat_attr(inode, backend.stat(fid), timeout=DEFAULT_TIMEOUT,
+                     generation=backend.generation)
+    attr.attr_timeout = ATTR_TIMEOUT
+    attr.st_mode &= ~0o222
+    return attr
+
+
+class StoredInodeHandler(BaseFile, BaseInodeHandler):
+
+    """Inode handler for a stored file.
+
+    Stored files are immutable, so they are exposed read only.  Their
+    attributes are exposed as extended attributes in the user namespace, so
+    the attribute with key foo is the extended attribute user.foo.  Changes
+    to extended attributes are buffered in the backend's journal.
+
+    """
+
+    _XATTR_PREFIX = b'user.'
+
+    def __init__(self, backend, fid, inode):
+        self.fid = fid
+        self._backend = backend
+        super().__init__(attr=_stored_attr(backend, fid, inode))
+
+    def getattr(self):
+        return self.attr
+
+    def access(self, mode, ctx):
+        return not mode & os.W_OK
+
+    def _xattr_key(self, name):
+        """Return attribute key for an extended attribute name."""
+        if not name.startswith(self._XATTR_PREFIX):
+            raise llfuse.FUSEError(errno.ENOTSUP)
+        try:
+            return name[len(self._XATTR_PREFIX):].decode()
+        except UnicodeDecodeError:
+            raise llfuse.FUSEError(errno.EINVAL)
+
+    def _attrs(self):
+        return unlocked(self._backend.journal.get_attrs, self.fid)
+
+    def getxattr(self, name):
+        try:
+            return self._attrs()[self._xattr_key(name)].encode()
+        except KeyError:
+            raise llfuse.FUSEError(errno.ENODATA)
+
+    def listxattr(self):
+        return [self._XATTR_PREFIX + key.encode() for key in self._attrs()]
+
+    def setxattr(self, name, value):
+        key = self._xattr_key(name)
+        try:
+            val = value.decode()
+        except UnicodeDecodeError:
+            raise llfuse.FUSEError(errno.EINVAL)
+        unlocked(self._backend.journal.set_attr, self.fid, key, val)
+
+    def removexattr(self, name):
+        key = self._xattr_key(name)
+        try:
+            unlocked(self._backend.journal.delete_attr, self.fid, key)
+        except KeyError:
+            raise llfuse.FUSEError(errno.ENODATA)
+
+    def open(self, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise llfuse.FUSEError(errno.EROFS)
+        if unlocked(self._backend.is_chunked, self.fid):
+            return ChunkedFileHandler(self._backend, self.fid)
+        return StoredFileHandler(self._backend, self.fid)
+
+
+class StoredFileHandler(BaseFileHandler):
+
+    """File handler for stored files.
+
+    Stored files are immutable, so all handles open on a file share one
+    memory mapping from the backend's map_cache, and reads return slices of
+    it without copying.
+
+    fsync also commits buffered metadata changes, so that applications can
+    make attribute changes durable.
+
+    """
+
+    def __init__(self, backend, fid):
+        self._backend = backend
+        self._mapping = do_os(unlocked, self._acquire, fid)
+
+    def _acquire(self, fid):
+        # Finding the path may read the storage layout from the database.
+        return self._backend.map_cache.acquire(
+            fid, self._backend.fid_path(fid))
+
+    def read(self, off, size):
+        return self._mapping.data[off:off + size]
+
+    def flush(self):
+        pass
+
+    def fsync(self, datasync):
+        unlocked(self._backend.journal.flush)
+        if datasync:
+            do_os(unlocked, os.fdatasync, self._mapping.fd)
+        else:
+            do_os(unlocked, os.fsync, self._mapping.fd)
+
+    def release(self):
+        self._backend.map_cache.release(self._mapping)
+
+
+class ChunkedFileHandler(BaseFileHandler):
+
+    """File handler for chunked files.  See dbooru.chunks.
+
+    Reads are assembled from the backend's chunk store, which caches
+    recently read chunks.
+
+    """
+
+    def __init__(self, backend, fid):
+        self._backend = backend
+        self._manifest = do_os(unlocked, self._load_manifest, fid)
+
+    def _load_manifest(self, fid):
+        return self._backend.chunk_store.manifest(
+            self._backend.manifest_path(fid))
+
+    def read(self, off, size):
+        return do_os(unlocked, self._backend.chunk_store.read,
+                     self._manifest, off, size)
+
+    def flush(self):
+        pass
+
+    def fsync(self, datasync):
+        unlocked(self._backend.journal.flush)
+
+    def release(self):
+        pass
+
+
+class FilesInodeHandler(BaseDir, BaseInodeHandler):
+
+    """Directory listing all stored files by fid.
+
+    The listing is read from the files table in batches, which gives the
+    inode numbers of the files too.
+
+    """
+
+    # Number of files read from the database at a time.
+    _BATCH = 1024
+
+    def __init__(self, backend, inodes, parent):
+        self._backend = backend
+        self._inodes = inodes
+        attr = make_attr(inodes.get('files'), DIR_MODE,
+                         generation=inodes.generation)
+        super().__init__(attr=attr, parent=parent)
+
+    def _fid_inode(self, fid):
+        try:
+            return self._inodes.fid_inode(fid)
+        except KeyError:
+            # Not recorded in the database.
+            return 0
+
+    def _stored_inode(self, fid):
+        """Return inode number of a recorded and stored file, or 0."""
+        inode = self._fid_inode(fid)
+        if inode and self._backend.exists(fid):
+            return inode
+        return 0
+
+    def lookup(self, name):
+        if name == b'.':
+            return self
+        elif name == b'..':
+            return self._parent
+        fid = os.fsdecode(name)
+        inode = unlocked(self._stored_inode, fid)
+        if not inode:
+            raise llfuse.FUSEError(errno.ENOENT)
+        return StoredInodeHandler(self._backend, fid, inode)
+
+    def opendir(self):
+        # Files written through the mount are stored before they are
+        # recorded; record them so they are listed.
+        unlocked(self._backend.journal.flush)
+        return self
+
+    def readdir(self, off):
+        # Offsets are ino column values, so listings resume where they left
+        # off even if files are added or deleted meanwhile.
+        while True:
+            rows = do_os(unlocked, self._backend.list_files, off,
+                         self._BATCH)
+            for fid, ino in rows:
+                attr = dirent_attr(self._inodes.from_row(ino), FILE_MODE)
+                yield (os.fsencode(fid), attr, ino)
+            if len(rows) < self._BATCH:
+                return
+            off = rows[-1][1]
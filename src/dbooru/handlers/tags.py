@@ -0,0 +1,200 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.handlers.tags
+
+This module contains the virtual directory tree for browsing files by tag.
+
+The top tags directory lists all attribute keys, from the tag vocabulary.
+Each path component below it is a query expression (see dbooru.query)
+narrowing the query of its parent, and each of these directories lists the
+matching files by fid.  For example, /tags/cat/rating=safe lists files with a
+cat attribute and a rating attribute with value safe.
+
+"""
+
+from collections import namedtuple
+import errno
+import itertools
+import os
+
+import llfuse
+
+from dbooru import query
+from dbooru.cache import LRUCache
+from dbooru.oslib import do_os
+from dbooru.oslib import unlocked
+
+from .base import BaseFileHandler
+from .base import BaseInodeHandler
+from .base import BaseLookupDir
+from .base import DIR_MODE
+from .base import FILE_MODE
+from .base import dirent_attr
+from .base import make_attr
+from .stored import StoredInodeHandler
+
+# names is the sorted list of entry names and index maps names to inode
+# numbers.
+Listing = namedtuple('Listing', ['names', 'index'])
+
+
+class TagInodeHandler(BaseLookupDir, BaseInodeHandler, BaseFileHandler):
+
+    """Virtual directory for a tag query.
+
+    Handlers of the most recently looked up subdirectories are kept.
+
+    """
+
+    # pylint: disable=too-many-arguments
+
+    # Number of subdirectory handlers to keep.
+    CHILDREN = 256
+
+    def __init__(self, backend, inodes, cache, terms=(), parent=None):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            inodes: InodeAllocator instance.
+            cache: ResultCache instance for listings, keyed by directory
+                inode.
+            terms: Tuple of query trees ANDed together for this directory.
+                Empty for the top tags directory.
+            parent: Parent directory handler.
+
+        """
+        self._backend = backend
+        self._inodes = inodes
+        self._cache = cache
+        self._terms = terms
+        self._children = LRUCache(self.CHILDREN)
+        attr = make_attr(inodes.get(('tags', terms)), DIR_MODE,
+                         generation=inodes.generation)
+        super().__init__(attr=attr, parent=parent, lookup_map={})
+
+    @property
+    def query(self):
+        """Query tree for this directory, or None for the top directory."""
+        if not self._terms:
+            return None
+        elif len(self._terms) == 1:
+            return self._terms[0]
+        return query.And(self._terms)
+
+    def getattr(self):
+        self.attr.st_size = self._size()
+        # Only the top directory has subdirectories listed.
+        self.attr.st_nlink = 2 + (0 if self._terms else self.attr.st_size)
+        return self.attr
+
+    def _size(self):
+        """Return number of entries, from tag statistics where possible."""
+        if not self._terms:
+            return do_os(unlocked, self._backend.tag_key_count)
+        term = self._terms[-1]
+        if len(self._terms) == 1 and isinstance(term, query.Tag):
+            return do_os(unlocked, self._backend.tag_count, term.key,
+                         term.val)
+        listing = self._cache.peek(self.attr.st_ino)
+        # Not worth running the query just to stat the directory.
+        return len(listing.names) if listing is not None else 0
+
+    def _listing(self):
+        return self._cache.get(self.attr.st_ino, self._list)
+
+    def _list(self):
+        if self._terms:
+            index = {fid: self._inodes.from_row(ino) for fid, ino
+                     in query.search(self._backend, self.query, inodes=True)}
+        else:
+            index = {}
+            for key, _ in self._backend.tags():
+                terms = (query.Tag(key, None),)
+                index[key] = self._inodes.get(('tags', terms))
+        return Listing(sorted(index), index)
+
+    def lookup(self, name):
+        if name in (b'.', b'..'):
+            return super().lookup(name)
+        text = os.fsdecode(name)
+        if self._terms and text in self._listing().index:
+            return StoredInodeHandler(
+                self._backend, text, self._listing().index[text])
+        child = self._children.get(text)
+        if child is None:
+            child = self._new_child(text)
+            self._children.put(text, child)
+        elif not child._exists():  # pylint: disable=protected-access
+            raise llfuse.FUSEError(errno.ENOENT)
+        return child
+
+    def _exists(self):
+        """Return whether any files match this directory's query.
+
+        Also updates the directory's attributes for the lookup reply.
+
+        """
+        if len(self._terms) == 1 and isinstance(self._terms[0], query.Tag):
+            return bool(self.getattr().st_size)
+        exists = bool(self._listing().names)
+        self.getattr()
+        return exists
+
+    def _new_child(self, text):
+        """Return handler for the subdirectory narrowed by query text.
+
+        In the top directory, text is first looked up as a key.  Raises
+        ENOENT if no files match, before making a handler, so failed
+        lookups don't allocate inode numbers.
+
+        """
+        # Keys listed in the top directory are looked up as they are listed,
+        # even if they aren't valid query text, such as keys with spaces.
+        term = query.Tag(text, None)
+        if self._terms or not unlocked(_matches, self._backend, (term,)):
+            try:
+                term = query.parse(text)
+            except query.QuerySyntaxError:
+                raise llfuse.FUSEError(errno.ENOENT)
+            if not unlocked(_matches, self._backend, self._terms + (term,)):
+                raise llfuse.FUSEError(errno.ENOENT)
+        terms = self._terms + (term,)
+        child = TagInodeHandler(self._backend, self._inodes, self._cache,
+                                terms=terms, parent=self)
+        child.getattr()
+        return child
+
+    def readdir(self, off):
+        listing = self._listing()
+        mode = FILE_MODE if self._terms else DIR_MODE
+        names = itertools.islice(listing.names, off, None)
+        for i, name in enumerate(names, off + 1):
+            attr = dirent_attr(listing.index[name], mode)
+            yield (os.fsencode(name), attr, i)
+
+
+def _matches(backend, terms):
+    """Return whether any files match all query trees in terms."""
+    if len(terms) == 1 and isinstance(terms[0], query.Tag):
+        return backend.tag_count(terms[0].key, terms[0].val) > 0
+    results = query.search(
+        backend, terms[0] if len(terms) == 1 else query.And(terms))
+    try:
+        return next(results, None) is not None
+    finally:
+        results.close()
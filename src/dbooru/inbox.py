@@ -0,0 +1,532 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.inbox
+
+This module implements a service importing files dropped into an inbox
+directory.
+
+Files go through a pipeline of stages, each run in its own threads and
+connected by bounded queues, so a slow stage makes the stages before it wait
+instead of buffering without limit:
+
+- Detecting: new files are found with inotify, or by polling where inotify
+  isn't available.  Files already in the inbox are found on start.  Files
+  whose names start with a dot are ignored, so they can be used for partial
+  downloads.
+- Settling: files are passed on once their size and modification time
+  haven't changed for a while, so files still being written are skipped.
+- Hashing: files are copied into staging and hashed in a pool of worker
+  threads, with a hard link if the inbox is on the same file system, so
+  files must not be changed once they have settled.  See
+  dbooru.ingest.stage_file().
+- Storing: staged files not already stored are moved into storage.
+- Committing: stored files are recorded in the database in batches, then
+  removed from the inbox.
+
+Files are only removed from the inbox after they are recorded, so files in
+the pipeline when the service stops are imported when it starts again.
+Batches that fail to be recorded because the database is busy or
+unavailable are retried with a growing delay, while the other stages wait.
+If a batch can't be recorded, the whole service stops.
+
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import queue
+import select
+import sqlite3
+import struct
+import threading
+import time
+
+from dbooru.ingest import ImportStats
+from dbooru.ingest import discard_staged
+from dbooru.ingest import file_stager
+from dbooru.ingest import record_files
+from dbooru.ingest import store_staged
+from dbooru.ingest import walk_files
+
+# From linux/inotify.h
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+# wd, mask, cookie, name length
+_EVENT = struct.Struct('iIII')
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds between checks for stopping in blocking stages.
+_TICK = 0.25
+# Seconds to wait before retrying a batch that failed to be recorded, doubled
+# after each consecutive failure up to the maximum.
+_RETRY_DELAY = 0.5
+_MAX_RETRY_DELAY = 60
+
+
+def _is_ignored(path):
+    return os.path.basename(path).startswith('.')
+
+
+class InotifyWatcher:
+
+    """Watches a directory tree for new files with inotify."""
+
+    def __init__(self, path):
+        """
+        Raises:
+            OSError: inotify isn't available.
+
+        """
+        self._path = path
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+        # Maps watch descriptors to directory paths.
+        self._dirs = {}
+        try:
+            self._add_tree(path)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
+
+    def _add_tree(self, path):
+        """Watch a directory tree and return paths of the files in it.
+
+        Directories are watched before they are listed, so no files are
+        missed.
+
+        """
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self._dirs[wd] = path
+        paths = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    try:
+                        paths.extend(self._add_tree(entry.path))
+                    except FileNotFoundError:
+                        pass
+                elif entry.is_file(follow_symlinks=False):
+                    paths.append(entry.path)
+        return paths
+
+    def poll(self, timeout):
+        """Return paths of new or changed files.
+
+        Waits up to timeout seconds for changes.
+
+        """
+        if not self._poll.poll(timeout * 1000):
+            return []
+        try:
+            data = os.read(self._fd, 2 ** 16)
+        except BlockingIOError:
+            return []
+        paths = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & _IN_Q_OVERFLOW:
+                # Events were lost.
+                paths.extend(walk_files([self._path]))
+                continue
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if not mask & _IN_ISDIR:
+                paths.append(path)
+            elif mask & (_IN_CREATE | _IN_MOVED_TO):
+                try:
+                    paths.extend(self._add_tree(path))
+                except FileNotFoundError:
+                    pass
+        return paths
+
+
+class PollingWatcher:
+
+    """Watches a directory tree for new files by listing it periodically."""
+
+    def __init__(self, path, interval=1.0):
+        self._path = path
+        self._interval = interval
+        # Maps paths to (size, mtime) when last listed.
+        self._seen = {}
+        self._next = time.monotonic() + interval
+
+    def close(self):
+        """Stop watching."""
+        self._seen = {}
+
+    def poll(self, timeout):
+        """Return paths of new or changed files.
+
+        Waits up to timeout seconds for the next listing.
+
+        """
+        wait = self._next - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if wait > timeout:
+                return []
+        self._next = time.monotonic() + self._interval
+        seen = {}
+        paths = []
+        for path in walk_files([self._path]):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            seen[path] = (stat.st_size, stat.st_mtime_ns)
+            if self._seen.get(path) != seen[path]:
+                paths.append(path)
+        self._seen = seen
+        return paths
+
+
+def make_watcher(path, polling=False, interval=1.0):
+    """Return an InotifyWatcher, or a PollingWatcher if unavailable."""
+    if not polling:
+        try:
+            return InotifyWatcher(path)
+        except OSError as err:
+            if err.errno not in (errno.ENOSYS, errno.EMFILE, errno.ENOSPC):
+                raise
+    return PollingWatcher(path, interval)
+
+
+class InboxError(Exception):
+    """The inbox stopped because a batch of files couldn't be recorded."""
+
+
+class InboxStats(ImportStats):
+
+    """Running totals for an inbox."""
+
+
+class Inbox:
+
+    """Service importing files dropped into a directory.
+
+    Example:
+
+        inbox = Inbox(backend, '/srv/inbox', attrs={'source': 'scraper'})
+        inbox.start()
+        ...
+        inbox.stop()
+
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, backend, path, workers=None, batch_size=1000,
+                 max_delay=5.0, settle=2.0, queue_size=1000, attrs=None,
+                 polling=False, poll_interval=1.0, progress=None,
+                 retries=10):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            path: Inbox directory.
+            workers: Number of hashing workers.  Defaults to the CPU count.
+            batch_size: Maximum number of files recorded per database
+                transaction.
+            max_delay: Maximum seconds a stored file waits to be recorded.
+            settle: Seconds a file must be unchanged before it is imported.
+            queue_size: Maximum number of files waiting in each stage.
+            attrs: Mapping of attributes to set on every imported file.
+            polling: Poll the inbox instead of using inotify.
+            poll_interval: Seconds between listings when polling.
+            progress: Callable called with an InboxStats after each batch.
+            retries: Number of times a batch that failed to be recorded is
+                retried before the inbox stops.
+
+        """
+        self._backend = backend
+        self._path = path
+        self._workers = workers or os.cpu_count() or 1
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._settle = settle
+        self._queue_size = queue_size
+        self._attrs = dict(attrs or {})
+        self._polling = polling
+        self._poll_interval = poll_interval
+        self._progress = progress
+        self._retries = retries
+        self._stage = file_stager(backend, hardlink=True)
+        self._detected = queue.Queue(queue_size)
+        self._settled = queue.Queue(queue_size)
+        self._hashed = queue.Queue(queue_size)
+        # Paths passed on from settling and not yet removed from the inbox.
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+        # The exception that stopped the inbox, if any.
+        self.error = None
+        self.stats = InboxStats()
+
+    def start(self):
+        """Start the pipeline threads."""
+        watcher = make_watcher(self._path, self._polling, self._poll_interval)
+        targets = [(self._detect_loop, watcher), (self._settle_loop,)]
+        targets.extend((self._hash_loop,) for _ in range(self._workers))
+        targets.append((self._commit_loop,))
+        for target, *args in targets:
+            thread = threading.Thread(target=target, args=args,
+                                      name='dbooru-inbox', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop the pipeline and wait for it to finish the current batch."""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        # Files staged but not stored are imported again on start.
+        while True:
+            try:
+                discard_staged(self._hashed.get_nowait())
+            except queue.Empty:
+                break
+
+    def run(self):
+        """Run until interrupted.
+
+        Raises:
+            InboxError: A batch of files couldn't be recorded.
+
+        """
+        self.start()
+        try:
+            self._stopping.wait()
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise InboxError('Recording files failed') from self.error
+
+    def _put(self, stage, item):
+        """Put item in a stage's queue, waiting for room unless stopping.
+
+        Returns whether the item was put.
+
+        """
+        while not self._stopping.is_set():
+            try:
+                stage.put(item, timeout=_TICK)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def _error(self, path):
+        with self._lock:
+            self.stats.errors += 1
+            self._in_flight.discard(path)
+
+    def _detect_loop(self, watcher):
+        try:
+            for path in walk_files([self._path]):
+                if not _is_ignored(path) and not self._put(
+                        self._detected, path):
+                    return
+            while not self._stopping.is_set():
+                for path in watcher.poll(_TICK):
+                    if not _is_ignored(path) and not self._put(
+                            self._detected, path):
+                        return
+        finally:
+            watcher.close()
+
+    def _settle_loop(self):
+        # Maps paths to (size, mtime) and when they were last seen changing.
+        pending = {}
+        next_check = time.monotonic()
+        while not self._stopping.is_set():
+            if len(pending) < self._queue_size:
+                try:
+                    path = self._detected.get(timeout=_TICK)
+                except queue.Empty:
+                    pass
+                else:
+                    with self._lock:
+                        if path not in self._in_flight:
+                            pending.setdefault(path, (None, 0))
+            else:
+                time.sleep(_TICK)
+            now = time.monotonic()
+            if now < next_check:
+                continue
+            next_check = now + min(_TICK, self._settle / 2)
+            for path, (last, since) in list(pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del pending[path]
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                age = time.time() - stat.st_mtime
+                if last is None and age >= self._settle:
+                    # Found long after it was last written.
+                    settled = True
+                elif current != last:
+                    pending[path] = (current, now)
+                    settled = False
+                else:
+                    settled = now - since >= self._settle
+                if settled:
+                    del pending[path]
+                    with self._lock:
+                        self._in_flight.add(path)
+                    if not self._put(self._settled, path):
+                        return
+
+    def _hash_loop(self):
+        while not self._stopping.is_set():
+            try:
+                path = self._settled.get(timeout=_TICK)
+            except queue.Empty:
+                continue
+            try:
+                staged = self._stage(path)
+            except OSError:
+                self._error(path)
+                continue
+            if not self._put(self._hashed, staged):
+                discard_staged(staged)
+                return
+
+    def _commit_loop(self):
+        batch = []
+        deadline = None
+        while True:
+            stopping = self._stopping.is_set()
+            if stopping or len(batch) >= self._batch_size or (
+                    batch and time.monotonic() >= deadline):
+                if batch:
+                    if not self._commit_retrying(batch):
+                        return
+                    batch = []
+                if stopping:
+                    return
+            try:
+                staged = self._hashed.get(timeout=_TICK)
+            except queue.Empty:
+                continue
+            try:
+                stored = store_staged(self._backend, staged)
+            except OSError:
+                discard_staged(staged)
+                self._error(staged.src)
+                continue
+            if not batch:
+                deadline = time.monotonic() + self._max_delay
+            batch.append((staged.src, staged.fid, staged.size, stored))
+
+    def _commit_retrying(self, batch):
+        """Commit a batch, retrying if recording it fails.
+
+        Errors other than the database being busy or unavailable aren't
+        retried.  If the batch can't be recorded, the inbox is stopped;
+        its files are left in the inbox.
+
+        Returns whether the batch was committed.
+
+        """
+        delay = _RETRY_DELAY
+        attempts = 0
+        while True:
+            try:
+                self._commit(batch)
+            except Exception as err:  # pylint: disable=broad-except
+                attempts += 1
+                with self._lock:
+                    self.stats.errors += 1
+                if (not isinstance(err, sqlite3.OperationalError)
+                        or attempts > self._retries):
+                    _LOGGER.exception(
+                        'Recording %d files failed, stopping', len(batch))
+                    self.error = err
+                    self._stopping.set()
+                    return False
+                _LOGGER.exception(
+                    'Recording %d files failed, retrying in %s seconds',
+                    len(batch), delay)
+                if self._stopping.wait(delay):
+                    # Left in the inbox for the next start.
+                    return False
+                delay = min(delay * 2, _MAX_RETRY_DELAY)
+            else:
+                return True
+
+    def _commit(self, batch):
+        """Record a batch of stored files and remove them from the inbox."""
+        record_files(self._backend, [fid for _, fid, _, _ in batch],
+                     self._attrs)
+        stats = self.stats
+        for path, _, size, stored in batch:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Recorded, but imported again if still there on start.
+                _LOGGER.exception('Removing %s from the inbox failed', path)
+                with self._lock:
+                    stats.errors += 1
+            with self._lock:
+                self._in_flight.discard(path)
+                if stored:
+                    stats.stored += 1
+                else:
+                    stats.skipped += 1
+                stats.files += 1
+                stats.bytes += size
+        if self._progress is not None:
+            self._progress(stats)
@@ -0,0 +1,413 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.ingest
+
+This module implements bulk importing of existing files into dbooru.
+
+Files are copied into staging and hashed in a worker pool, then stored and
+recorded in the database in large batches.  Importing can be resumed by
+giving a checkpoint file, which records the source paths of files whose batch
+has been committed.  Files that can't be read are counted as errors and left
+out of the checkpoint, so they are tried again when importing is resumed.
+
+"""
+
+from collections import deque
+from collections import namedtuple
+import concurrent.futures
+import errno
+import fcntl
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+
+from dbooru.chunks import Chunker
+from dbooru.chunks import MANIFEST_SUFFIX
+
+_LOGGER = logging.getLogger(__name__)
+
+_FICLONE = 0x40049409  # From linux/fs.h
+_READ_LENGTH = 2 ** 20  # 1 MiB
+
+# A file copied into staging by stage_file().  path is the staged copy and
+# chunks is None unless its chunks were found while it was read.
+StagedFile = namedtuple('StagedFile',
+                        ['src', 'fid', 'size', 'path', 'chunks'])
+
+# A file that _try_stage() couldn't stage.
+_FailedFile = namedtuple('_FailedFile', ['src', 'error'])
+
+
+def walk_files(paths):
+    """Yield paths of regular files under the given paths.
+
+    Symlinks are not followed.
+
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _walk_dir(path)
+        elif os.path.isfile(path):
+            yield path
+
+
+def _walk_dir(path):
+    """Yield paths of regular files in a directory tree."""
+    with os.scandir(path) as entries:
+        dirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+    for subdir in dirs:
+        yield from _walk_dir(subdir)
+
+
+def bounded_map(executor, func, iterable, window):
+    """Like Executor.map(), but don't submit all of iterable at once.
+
+    At most window calls are pending at any time, so huge iterables don't
+    consume unbounded memory.  Results are yielded in order.
+
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _write_all(fd, data):
+    """Write all of data to fd."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _clone(src, src_fd, dst_path, dst_fd, hardlink):
+    """Make the staged file at dst_path share its data with src if possible.
+
+    Returns True if a hard link or reflink was made, else False.
+
+    """
+    if hardlink:
+        link_path = dst_path + '.link'
+        try:
+            os.link(src, link_path)
+        except OSError:
+            pass
+        else:
+            os.replace(link_path, dst_path)
+            return True
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    except OSError as err:
+        if err.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                             errno.ENOTTY):
+            raise
+        return False
+    return True
+
+
+def _read_hashed(file, chunker, dst_fd=None):
+    """Hash a file, copying it to dst_fd if given, in a single read.
+
+    Returns the fid and size of the data read.
+
+    """
+    hasher = hashlib.sha256()
+    size = 0
+    for data in iter(lambda: file.read(_READ_LENGTH), b''):
+        if dst_fd is not None:
+            _write_all(dst_fd, data)
+        hasher.update(data)
+        if chunker is not None:
+            chunker.update(data)
+        size += len(data)
+    return hasher.hexdigest(), size
+
+
+def stage_file(src, staging_dir, hardlink=False, chunking=None):
+    """Put a copy of src in the staging directory and hash the copy.
+
+    The copy is reflinked if the file system supports it, otherwise it is
+    copied while it is hashed, so each file is read once and the fid always
+    matches the staged data.  If hardlink is true, a hard link is tried
+    first; note that changes to a hard linked source file corrupt the stored
+    file.  Module level so it can be used with a process pool.
+
+    Args:
+        src: Path of the file.
+        staging_dir: Staging directory of the backend.
+        hardlink: Try hard linking the file first.
+        chunking: Tuple of the chunk threshold and chunk sizes of the
+            backend, if it stores large files in chunks, so their chunks are
+            found in the same read.  See file_stager().
+
+    Returns:
+        StagedFile for the copy, to be passed to store_staged().
+
+    """
+    tmp_fd, path = tempfile.mkstemp(dir=staging_dir)
+    try:
+        with open(src, 'rb', buffering=0) as file:
+            chunker = None
+            if (chunking is not None
+                    and os.fstat(file.fileno()).st_size >= chunking[0]):
+                chunker = Chunker(*chunking[1:])
+            if _clone(src, file.fileno(), path, tmp_fd, hardlink):
+                with open(path, 'rb', buffering=0) as staged:
+                    fid, size = _read_hashed(staged, chunker)
+            else:
+                fid, size = _read_hashed(file, chunker, tmp_fd)
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(tmp_fd)
+    chunks = None
+    if chunker is not None:
+        chunker.finish()
+        chunks = chunker.chunks
+    return StagedFile(src, fid, size, path, chunks)
+
+
+def file_stager(backend, hardlink=False):
+    """Return stage_file() with the backend's arguments filled in.
+
+    The result can be pickled, so it can be used with a process pool.
+
+    """
+    chunking = None
+    if backend.chunk_threshold is not None:
+        chunk_store = backend.chunk_store
+        chunking = (backend.chunk_threshold, chunk_store.min_size,
+                    chunk_store.avg_size, chunk_store.max_size)
+    return functools.partial(stage_file, staging_dir=backend.staging_dir,
+                             hardlink=hardlink, chunking=chunking)
+
+
+def _try_stage(stager, src):
+    """Call stager on src, returning a _FailedFile if it raises OSError.
+
+    Module level so it can be used with a process pool.
+
+    """
+    try:
+        return stager(src)
+    except OSError as err:
+        return _FailedFile(src, err)
+
+
+def store_staged(backend, staged):
+    """Move a file staged by stage_file() into storage under its fid.
+
+    Files at least as large as the backend's chunk threshold are stored in
+    chunks instead.
+
+    Returns False if the fid was already stored, in which case the staged
+    file is discarded, else True.
+
+    """
+    fid = staged.fid
+    if backend.exists(fid):
+        os.unlink(staged.path)
+        return False
+    threshold = backend.chunk_threshold
+    if threshold is not None and staged.size >= threshold:
+        chunk_store = backend.chunk_store
+        if staged.chunks is not None:
+            manifest = chunk_store.store_chunks(staged.path, staged.chunks)
+        else:
+            manifest = chunk_store.write_manifest(staged.path)
+        os.unlink(staged.path)
+        os.rename(manifest, backend.store_path(fid + MANIFEST_SUFFIX))
+    else:
+        os.rename(staged.path, backend.store_path(fid))
+    backend.attr_cache.pop(fid)
+    return True
+
+
+def discard_staged(staged):
+    """Remove a file staged by stage_file() without storing it."""
+    try:
+        os.unlink(staged.path)
+    except FileNotFoundError:
+        pass
+
+
+def record_files(backend, fids, attrs):
+    """Record stored files and set attributes on them in one transaction.
+
+    Files already recorded are kept and get the attributes set, replacing
+    existing values, so a batch can be recorded again, such as when it is
+    retried.
+
+    """
+    attr_rows = [(fid, key, val) for fid in fids for key, val in attrs.items()]
+    with backend.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO files (fid) VALUES (?)',
+            [(fid,) for fid in fids])
+        conn.executemany(
+            'INSERT INTO attributes VALUES (?, ?, ?)', attr_rows)
+    for fid in fids:
+        backend.journal.invalidate(fid)
+    backend.changed()
+
+
+class ImportStats:
+
+    """Running totals for an import."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.stored = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return ('{cls}(files={files}, bytes={bytes}, stored={stored},'
+                ' skipped={skipped}, errors={errors})').format(
+                    cls=type(self).__name__, **vars(self))
+
+
+class Importer:
+
+    """Bulk importer for existing files.
+
+    Example:
+
+        importer = Importer(backend, checkpoint='import.log')
+        importer.run(['/path/to/collection'], attrs={'source': 'scan'})
+
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, backend, workers=None, processes=False,
+                 batch_size=1000, hardlink=False, checkpoint=None,
+                 progress=None):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            workers: Number of copying and hashing workers.  Defaults to the
+                CPU count.
+            processes: Use a process pool instead of a thread pool.
+            batch_size: Number of files recorded per database transaction.
+            hardlink: Try hard linking files into storage.  See stage_file().
+            checkpoint: Path to a file recording committed source paths.  If
+                the file exists, paths listed in it are skipped.  Paths of
+                files that couldn't be read aren't recorded.
+            progress: Callable called with an ImportStats after each batch
+                and each file that couldn't be read.
+
+        """
+        self._backend = backend
+        self._workers = workers or os.cpu_count() or 1
+        self._processes = processes
+        self._batch_size = batch_size
+        self._hardlink = hardlink
+        self._checkpoint = checkpoint
+        self._progress = progress
+        self.stats = ImportStats()
+
+    def _load_checkpoint(self):
+        """Return set of source paths already imported."""
+        if self._checkpoint is None:
+            return set()
+        try:
+            with open(self._checkpoint, encoding='utf-8',
+                      errors='surrogateescape') as file:
+                return set(line.rstrip('\n') for line in file)
+        except FileNotFoundError:
+            return set()
+
+    def _make_executor(self):
+        if self._processes:
+            return concurrent.futures.ProcessPoolExecutor(self._workers)
+        else:
+            return concurrent.futures.ThreadPoolExecutor(self._workers)
+
+    def run(self, paths, attrs=None):
+        """Import files under the given paths.
+
+        Args:
+            paths: Iterable of files and directories to import.
+            attrs: Mapping of attributes to set on every imported file.
+
+        Returns:
+            ImportStats for this run.
+
+        """
+        attrs = dict(attrs or {})
+        done = self._load_checkpoint()
+        sources = (path for path in walk_files(paths) if path not in done)
+        checkpoint = None
+        if self._checkpoint is not None:
+            checkpoint = open(self._checkpoint, 'a', encoding='utf-8',
+                              errors='surrogateescape')
+        try:
+            with self._make_executor() as executor:
+                stager = functools.partial(
+                    _try_stage, file_stager(self._backend, self._hardlink))
+                staged = bounded_map(executor, stager, sources,
+                                     self._workers * 4)
+                batch = []
+                for item in staged:
+                    if isinstance(item, _FailedFile):
+                        # Vanished or unreadable since it was found.
+                        _LOGGER.warning('Importing %s failed: %s',
+                                        item.src, item.error)
+                        self.stats.errors += 1
+                        if self._progress is not None:
+                            self._progress(self.stats)
+                        continue
+                    batch.append(item)
+                    if len(batch) >= self._batch_size:
+                        self._commit(batch, attrs, checkpoint)
+                        batch = []
+                if batch:
+                    self._commit(batch, attrs, checkpoint)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+        return self.stats
+
+    def _commit(self, batch, attrs, checkpoint):
+        """Store a batch of staged files and record them."""
+        stats = self.stats
+        for staged in batch:
+            if store_staged(self._backend, staged):
+                stats.stored += 1
+            else:
+                stats.skipped += 1
+            stats.files += 1
+            stats.bytes += staged.size
+        record_files(self._backend, [staged.fid for staged in batch], attrs)
+        if checkpoint is not None:
+            checkpoint.writelines(staged.src + '\n' for staged in batch)
+            checkpoint.flush()
+        if self._progress is not None:
+            self._progress(stats)
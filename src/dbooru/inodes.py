@@ -0,0 +1,91 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.inodes
+
+This module assigns inode numbers to the files and directories exposed by
+the FUSE file system.
+
+"""
+
+import itertools
+import threading
+
+import llfuse
+
+from dbooru.cache import LRUCache
+
+
+class InodeAllocator:
+
+    """Assigns inode numbers.
+
+    Stored files get persistent inode numbers from the backend, offset past
+    the root inode, so they are the same across mounts.  Virtual files are
+    identified by hashable keys, such as their virtual path, and are assigned
+    numbers from a separate range on first use.  The most recently used keys
+    are remembered, so they keep their inode numbers; a forgotten key is
+    given a new number if used again.  Numbers are never reused, so inodes
+    the kernel still refers to stay valid.
+
+    Virtual inode numbers differ between mounts, so virtual files use a
+    separate generation number, which should be different for every mount.
+
+    """
+
+    VIRTUAL_BASE = 2 ** 48
+
+    def __init__(self, backend, generation=0, size=65536):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            generation: Generation number for virtual inodes.
+            size: Number of virtual file keys to remember.
+
+        """
+        self._backend = backend
+        self.generation = generation
+        self._counter = itertools.count(self.VIRTUAL_BASE)
+        self._inodes = LRUCache(size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return inode number for a virtual file, assigning one if needed."""
+        with self._lock:
+            inode = self._inodes.get(key)
+            if inode is None:
+                inode = next(self._counter)
+                self._inodes.put(key, inode)
+            return inode
+
+    def stats(self):
+        """Return dict of statistics of the remembered virtual inodes."""
+        return self._inodes.stats()
+
+    def fid_inode(self, fid):
+        """Return inode number for a stored file.
+
+        Raises KeyError if the file isn't recorded.
+
+        """
+        return self.from_row(self._backend.inode(fid))
+
+    @staticmethod
+    def from_row(ino):
+        """Return inode number for a stored file's ino column value."""
+        # pylint: disable=no-member
+        return llfuse.ROOT_INODE + ino
@@ -0,0 +1,398 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.journal
+
+This module implements write-behind buffering of metadata changes.
+
+Changes to the files and attributes tables are buffered in memory and
+committed together in one transaction (group commit), which is much faster
+than committing each change on slow storage.
+
+To keep the database consistent with the stored files across crashes, adding
+or deleting a file leaves a marker in the staging directory until the change
+is committed.  Markers are named after the name the file is stored as, which
+is its fid, or its manifest name for chunked files (see dbooru.chunks):
+
+- Adding a file hard links it as <name>.new in the staging directory before
+  moving it into storage.  If the add wasn't committed, recover() records it.
+- Deleting a file moves it to <name>.deleted in the staging directory.  If
+  the delete wasn't committed, recover() moves it back.
+
+So the database never refers to a file that isn't stored, and stored files
+are always eventually recorded.  Attribute changes that weren't committed are
+lost in a crash; set max_delay to 0 to commit every change immediately.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+from dbooru.cache import LRUCache
+
+_LOGGER = logging.getLogger(__name__)
+
+# Marks a pending attribute deletion.
+_DELETED = object()
+
+_ADD = 'add'
+_DELETE = 'delete'
+_NEW_SUFFIX = '.new'
+_DELETED_SUFFIX = '.deleted'
+# Seconds to wait before retrying a failed background flush, doubled after
+# each consecutive failure up to the maximum.
+_RETRY_DELAY = 0.5
+_MAX_RETRY_DELAY = 60
+
+
+class Journal:
+
+    """Write-behind buffer for metadata changes and cache for attributes.
+
+    Changes are buffered in memory and applied to the database together in
+    one transaction.  The buffer is flushed when max_pending changes are
+    buffered, max_delay seconds after the first buffered change, or when
+    flush() is called.  Later changes to the same attribute replace earlier
+    ones in the buffer.  If writing changes fails, they are buffered again
+    and the background thread retries with increasing delays.
+
+    Attribute reads are served from an LRU cache of each file's attributes,
+    which always reflects buffered changes.
+
+    """
+
+    def __init__(self, backend, max_pending=1000, max_delay=1.0,
+                 cache_size=4096):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            max_pending: Number of buffered changes that triggers a flush.
+            max_delay: Maximum seconds to buffer a change.  If 0, changes
+                are committed immediately.
+            cache_size: Number of files whose attributes are cached.
+
+        """
+        self._backend = backend
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.cache = LRUCache(cache_size)
+        # Maps fid to dict mapping key to value or _DELETED.
+        self._pending = {}
+        # List of (_ADD or _DELETE, fid, stored name), in order.
+        self._file_ops = []
+        # Fids in _file_ops.
+        self._file_fids = set()
+        self._pending_count = 0
+        self._deadline = None
+        self._cond = threading.Condition()
+        # Held while changes are being written, so that cache misses don't
+        # read the database while it doesn't reflect them yet.
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._closed = False
+
+    def get_attrs(self, fid):
+        """Return dict of a file's attributes, including buffered changes.
+
+        The returned dict must not be modified.
+
+        """
+        attrs = self.cache.get(fid)
+        if attrs is not None:
+            return attrs
+        with self._flush_lock:
+            attrs = self._backend.read_attrs(fid)
+            with self._cond:
+                _apply(attrs, self._pending.get(fid, {}))
+                self.cache.put(fid, attrs)
+        return attrs
+
+    def _marker(self, name, suffix):
+        return os.path.join(self._backend.staging_dir, name + suffix)
+
+    def add_file(self, fid, path, name=None):
+        """Move a file into storage and buffer recording it.
+
+        Args:
+            fid: Fid of the file.
+            path: Path of the file in the staging directory.
+            name: Name to store the file as, which starts with the fid.
+                Defaults to the fid.
+
+        """
+        name = name or fid
+        marker = self._marker(name, _NEW_SUFFIX)
+        try:
+            os.link(path, marker)
+        except FileExistsError:
+            pass
+        os.rename(path, self._backend.store_path(name))
+        self._buffer_file(_ADD, fid, name)
+
+    def delete_file(self, fid, name=None):
+        """Remove a file from storage and buffer deleting its record.
+
+        name is the name the file is stored as, as for add_file().
+
+        """
+        name = name or fid
+        os.rename(self._backend.fid_path(name),
+                  self._marker(name, _DELETED_SUFFIX))
+        self.discard(fid)
+        self._buffer_file(_DELETE, fid, name)
+
+    def is_pending(self, fid):
+        """Return whether the file has a buffered add or delete."""
+        with self._cond:
+            return fid in self._file_fids
+
+    def _buffer_file(self, operation, fid, name):
+        with self._cond:
+            self._start_timer()
+            self._file_ops.append((operation, fid, name))
+            self._file_fids.add(fid)
+            self._pending_count += 1
+            full = self._is_full()
+        if full:
+            self.flush()
+
+    def set_attr(self, fid, key, val):
+        """Buffer setting an attribute."""
+        self._buffer(fid, key, val)
+
+    def delete_attr(self, fid, key):
+        """Buffer deleting an attribute.
+
+        Raises KeyError if the file doesn't have the attribute.
+
+        """
+        if key not in self.get_attrs(fid):
+            raise KeyError(key)
+        self._buffer(fid, key, _DELETED)
+
+    def _start_timer(self):
+        """Start the flush timer if nothing is buffered yet, and the
+        background thread if it isn't running.
+
+        Must be called with _cond held.
+
+        """
+        if not self._pending_count:
+            self._deadline = time.monotonic() + self.max_delay
+            self._cond.notify()
+        self._start_flusher()
+
+    def _is_full(self):
+        return (self._pending_count >= self.max_pending
+                or self.max_delay <= 0)
+
+    def _buffer(self, fid, key, val):
+        with self._cond:
+            self._start_timer()
+            self._pending.setdefault(fid, {})[key] = val
+            self._pending_count += 1
+            attrs = self.cache.get(fid)
+            if attrs is not None:
+                # Replace rather than modify, as callers may hold the dict.
+                attrs = dict(attrs)
+                _apply(attrs, {key: val})
+                self.cache.put(fid, attrs)
+            full = self._is_full()
+        if full:
+            self.flush()
+
+    def invalidate(self, fid):
+        """Drop cached attributes for a file changed outside the journal."""
+        self.cache.pop(fid)
+
+    def discard(self, fid):
+        """Drop cached attributes and buffered changes for a file."""
+        with self._cond:
+            changes = self._pending.pop(fid, {})
+            self._pending_count -= len(changes)
+            self.cache.pop(fid)
+
+    def flush(self):
+        """Write buffered changes to the database.
+
+        If writing fails, the changes are buffered again, ahead of changes
+        buffered meanwhile, and the error is raised.
+
+        """
+        with self._flush_lock:
+            with self._cond:
+                pending = self._pending
+                file_ops = self._file_ops
+                file_fids = self._file_fids
+                self._pending = {}
+                self._file_ops = []
+                self._file_fids = set()
+                self._pending_count = 0
+            if not pending and not file_ops:
+                return
+            try:
+                with self._backend.stats.timer('journal.flush'):
+                    self._write(pending, file_ops)
+            except BaseException:
+                self._requeue(pending, file_ops, file_fids)
+                raise
+
+    def _requeue(self, pending, file_ops, file_fids):
+        """Buffer changes that failed to be written again."""
+        with self._cond:
+            for fid, changes in self._pending.items():
+                pending.setdefault(fid, {}).update(changes)
+            self._pending = pending
+            self._file_ops = file_ops + self._file_ops
+            self._file_fids = file_fids | self._file_fids
+            self._pending_count = len(self._file_ops) + sum(
+                len(changes) for changes in pending.values())
+
+    def _write(self, pending, file_ops):
+        """Write changes to the database and remove staging markers."""
+        sets = []
+        deletes = []
+        for fid, changes in pending.items():
+            for key, val in changes.items():
+                if val is _DELETED:
+                    deletes.append((fid, key))
+                else:
+                    sets.append((key, val, fid))
+        with self._backend.transaction() as conn:
+            for operation, fid, _ in file_ops:
+                if operation == _ADD:
+                    conn.execute(
+                        'INSERT OR IGNORE INTO files (fid) VALUES (?)',
+                        (fid,))
+                else:
+                    conn.execute('DELETE FROM files WHERE fid=?', (fid,))
+            conn.executemany(
+                'DELETE FROM attributes WHERE fid=? AND key=?', deletes)
+            # Skip files deleted since the change was buffered.
+            conn.executemany(
+                '''INSERT INTO attributes
+                SELECT fid, ?, ? FROM files WHERE fid=?''', sets)
+        self._backend.changed()
+        for operation, _, name in file_ops:
+            suffix = _NEW_SUFFIX if operation == _ADD else _DELETED_SUFFIX
+            try:
+                os.unlink(self._marker(name, suffix))
+            except FileNotFoundError:
+                pass
+
+    def recover(self):
+        """Reconcile files left by uncommitted adds and deletes.
+
+        This must not be called while changes are buffered.
+
+        """
+        conn = self._backend.conn
+        for marker_name in os.listdir(self._backend.staging_dir):
+            name, suffix = os.path.splitext(marker_name)
+            if suffix not in (_NEW_SUFFIX, _DELETED_SUFFIX):
+                continue
+            fid = name.partition('.')[0]
+            marker = self._marker(name, suffix)
+            if suffix == _NEW_SUFFIX:
+                if os.path.exists(self._backend.fid_path(name)):
+                    with self._backend.transaction():
+                        conn.execute(
+                            'INSERT OR IGNORE INTO files (fid) VALUES (?)',
+                            (fid,))
+                os.unlink(marker)
+            else:
+                recorded = conn.execute(
+                    'SELECT 1 FROM files WHERE fid=?', (fid,)).fetchone()
+                if recorded:
+                    os.rename(marker, self._backend.store_path(name))
+                else:
+                    os.unlink(marker)
+        self._backend.changed()
+
+    def _start_flusher(self):
+        """Start background flushing thread if needed.
+
+        Must be called with _cond held.
+
+        """
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name='dbooru-journal', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        try:
+            self._run_flusher()
+        finally:
+            with self._cond:
+                if self._flusher is threading.current_thread():
+                    self._flusher = None
+
+    def _run_flusher(self):
+        delay = _RETRY_DELAY
+        while True:
+            with self._cond:
+                while not self._pending_count and not self._closed:
+                    self._cond.wait()
+                while self._pending_count and not self._closed:
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception(
+                    'Writing journal failed, retrying in %s seconds', delay)
+                with self._cond:
+                    self._deadline = time.monotonic() + delay
+                delay = min(delay * 2, _MAX_RETRY_DELAY)
+            else:
+                delay = _RETRY_DELAY
+
+    def close(self):
+        """Flush buffered changes and stop the background thread.
+
+        The journal can still be used afterward; the thread is restarted when
+        needed.
+
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            flusher = self._flusher
+        if flusher is not None:
+            flusher.join()
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = False
+                self._flusher = None
+
+
+def _apply(attrs, changes):
+    """Apply buffered changes to an attribute dict."""
+    for key, val in changes.items():
+        if val is _DELETED:
+            attrs.pop(key, None)
+        else:
+            attrs[key] = val
@@ -0,0 +1,121 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.layout
+
+This module implements walking and migrating the storage layout.
+
+See DbooruBackend.layout() for a description of the layout.  Migrating to a
+new fanout is done online: the new layout is recorded first, along with the
+old one, so the backend looks for files in both while they are moved.  Moving
+a file is an atomic rename, so files can be read and written throughout.  An
+interrupted migration is resumed by running it again.
+
+"""
+
+import os
+import re
+import time
+
+from dbooru.chunks import MANIFEST_SUFFIX
+
+_STORED_RE = re.compile(
+    r'[0-9a-f]{64}(?:' + re.escape(MANIFEST_SUFFIX) + r')?\Z')
+
+
+def walk_stored(files_dir):
+    """Yield os.DirEntry objects for the stored files under files_dir.
+
+    Files are found in any layout, including while migrating.  Manifests of
+    chunked files are included; use stored_fid() to get the fid of an entry.
+
+    """
+    with os.scandir(files_dir) as entries:
+        dirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif _STORED_RE.match(entry.name):
+                yield entry
+    for path in dirs:
+        yield from walk_stored(path)
+
+
+def stored_fid(name):
+    """Return the fid of a stored file name from walk_stored()."""
+    return name.partition('.')[0]
+
+
+def _remove_old_dirs(path, fanout, depth=0):
+    """Remove empty directories deeper than fanout levels under path."""
+    with os.scandir(path) as entries:
+        subdirs = [entry.path for entry in entries
+                   if entry.is_dir(follow_symlinks=False)]
+    for subdir in subdirs:
+        _remove_old_dirs(subdir, fanout, depth + 1)
+    if depth > fanout:
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+def migrate(backend, fanout, batch_size=1000, delay=0, progress=None):
+    """Move stored files to a layout with a new fanout.
+
+    Args:
+        backend: DbooruBackend instance.
+        fanout: New fanout.
+        batch_size: Number of files to move between pauses.
+        delay: Seconds to pause after each batch, to limit the load on a live
+            instance.
+        progress: Callable called with the number of files moved so far after
+            each batch.
+
+    Returns:
+        Number of files moved.
+
+    """
+    current, old_fanout = backend.layout()
+    if old_fanout is None:
+        if current == fanout:
+            return 0
+        backend.set_layout(fanout, current)
+        # Wait for other processes to notice the new layout, so they store
+        # new files in it.
+        time.sleep(2 * backend.LAYOUT_TTL)
+    elif current != fanout:
+        raise ValueError(
+            'Migration to fanout {} is in progress'.format(current))
+    moved = 0
+    for entry in walk_stored(backend.files_dir):
+        path = backend.layout_path(entry.name, fanout)
+        if entry.path == path:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.rename(entry.path, path)
+        moved += 1
+        if moved % batch_size == 0:
+            if progress is not None:
+                progress(moved)
+            if delay:
+                time.sleep(delay)
+    _remove_old_dirs(backend.files_dir, fanout)
+    backend.set_layout(fanout)
+    if progress is not None:
+        progress(moved)
+    return moved
@@ -35,3 +35,15 @@ def do_os(func, *args, **kwargs):
         return func(*args, **kwargs)
     except OSError as err:
         raise llfuse.FUSEError(err.errno)
+
+
+def unlocked(func, *args, **kwargs):
+    """Call function with the llfuse global lock released.
+
+    Use this for calls that may block, such as disk reads and database
+    queries, so that other requests can be served in the meantime.  The
+    function must not touch state that isn't thread safe.
+
+    """
+    with llfuse.lock_released:
+        return func(*args, **kwargs)
@@ -0,0 +1,308 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.query
+
+This module implements tag queries over the attributes table.
+
+Queries are boolean expressions of tags.  A tag is either a bare key, which
+matches files that have the attribute regardless of its value, or key=value.
+Values containing spaces or parentheses can be double quoted.  Terms are
+combined with AND, OR and NOT (in order of increasing precedence) and grouped
+with parentheses.  Adjacent terms are implicitly ANDed:
+
+    cat outdoor
+    cat AND (rating=safe OR rating="very safe") AND NOT blurry
+
+"""
+
+from collections import namedtuple
+import re
+
+Tag = namedtuple('Tag', ['key', 'val'])
+And = namedtuple('And', ['terms'])
+Or = namedtuple('Or', ['terms'])
+Not = namedtuple('Not', ['term'])
+
+_KEYWORDS = ('AND', 'OR', 'NOT')
+_TOKEN_RE = re.compile(r'\s*(?:([()])|((?:[^\s()"]|"[^"]*")+))')
+
+
+class QuerySyntaxError(ValueError):
+    """Invalid query expression."""
+
+
+def _tokenize(text):
+    """Yield tokens in query text."""
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None:
+            raise QuerySyntaxError('Invalid query at {!r}'.format(text[pos:]))
+        yield match.group(1) or match.group(2)
+        pos = match.end()
+
+
+def _parse_tag(token):
+    """Parse tag term."""
+    key, sep, val = token.replace('"', '').partition('=')
+    if not key:
+        raise QuerySyntaxError('Empty tag key in {!r}'.format(token))
+    return Tag(key, val if sep else None)
+
+
+class _Parser:
+
+    """Recursive descent parser for query expressions."""
+
+    def __init__(self, text):
+        self._tokens = list(_tokenize(text))
+        self._pos = 0
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise QuerySyntaxError('Unexpected end of query')
+        self._pos += 1
+        return token
+
+    def parse(self):
+        if self._peek() is None:
+            raise QuerySyntaxError('Empty query')
+        node = self._or()
+        if self._peek() is not None:
+            raise QuerySyntaxError('Unexpected {!r}'.format(self._peek()))
+        return node
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek() == 'OR':
+            self._next()
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else Or(tuple(terms))
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND':
+                self._next()
+            terms.append(self._not())
+        return terms[0] if len(terms) == 1 else And(tuple(terms))
+
+    def _not(self):
+        if self._peek() == 'NOT':
+            self._next()
+            return Not(self._not())
+        return self._atom()
+
+    def _atom(self):
+        token = self._next()
+        if token == '(':
+            node = self._or()
+            if self._next() != ')':
+                raise QuerySyntaxError('Expected )')
+            return node
+        elif token == ')' or token in _KEYWORDS:
+            raise QuerySyntaxError('Unexpected {!r}'.format(token))
+        return _parse_tag(token)
+
+
+def parse(text):
+    """Parse query text into a query tree."""
+    return _Parser(text).parse()
+
+
+class Planner:
+
+    """Compiles query trees into SQL.
+
+    Conjunctions are driven by their most selective positive term, scanned
+    using the (key, val, fid) index.  Selectivity is estimated from the tag
+    statistics maintained by the backend, without scanning.  The remaining
+    terms are checked per file as correlated EXISTS lookups on the (fid, key)
+    primary key, so no intermediate result sets are materialized and results
+    can be streamed.
+
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._estimates = {}
+        self._alias_count = 0
+
+    def estimate(self, node):
+        """Return estimated number of files matching a query tree."""
+        if isinstance(node, Tag):
+            if node not in self._estimates:
+                self._estimates[node] = self._count_tag(node)
+            return self._estimates[node]
+        elif isinstance(node, And):
+            positive = [term for term in node.terms
+                        if not isinstance(term, Not)]
+            if not positive:
+                return self._count_files()
+            return min([self.estimate(term) for term in positive]
+                       + self._pair_estimates(positive))
+        elif isinstance(node, Or):
+            return sum(self.estimate(term) for term in node.terms)
+        elif isinstance(node, Not):
+            return max(self._count_files() - self.estimate(node.term), 0)
+        raise TypeError('Invalid query node {!r}'.format(node))
+
+    def _pair_estimates(self, terms):
+        """Return list of co-occurrence counts of pairs of tag terms.
+
+        Each count bounds the number of files matching both terms.
+
+        """
+        keys = sorted(set(term.key for term in terms
+                          if isinstance(term, Tag)))
+        counts = []
+        for i, key1 in enumerate(keys):
+            for key2 in keys[i + 1:]:
+                pair = (key1, key2)
+                if pair not in self._estimates:
+                    self._estimates[pair] = self._backend.tag_pair_count(
+                        key1, key2)
+                if self._estimates[pair] is not None:
+                    counts.append(self._estimates[pair])
+        return counts
+
+    def _count_tag(self, tag):
+        return self._backend.tag_count(tag.key, tag.val)
+
+    def _count_files(self):
+        if None not in self._estimates:
+            self._estimates[None] = self._backend.file_count()
+        return self._estimates[None]
+
+    def _alias(self):
+        self._alias_count += 1
+        return 'a{}'.format(self._alias_count)
+
+    def select(self, node):
+        """Return SQL and parameters selecting fids matching a query tree."""
+        if isinstance(node, Tag):
+            sql, params = _tag_where(node)
+            return 'SELECT fid FROM attributes WHERE ' + sql, params
+        elif isinstance(node, And):
+            terms = sorted(node.terms, key=self._and_order)
+            if isinstance(terms[0], Not):
+                driver_sql, params = 'SELECT fid FROM files', []
+            else:
+                driver_sql, params = self.select(terms[0])
+                terms = terms[1:]
+            alias = self._alias()
+            conds = []
+            for term in terms:
+                cond_sql, cond_params = self.condition(
+                    term, alias + '.fid')
+                conds.append(cond_sql)
+                params.extend(cond_params)
+            sql = 'SELECT {alias}.fid FROM ({driver}) AS {alias}'.format(
+                alias=alias, driver=driver_sql)
+            if conds:
+                sql += ' WHERE ' + ' AND '.join(conds)
+            return sql, params
+        elif isinstance(node, Or):
+            parts = [self.select(term) for term in node.terms]
+            return (' UNION '.join(sql for sql, _ in parts),
+                    [param for _, params in parts for param in params])
+        elif isinstance(node, Not):
+            cond_sql, params = self.condition(node.term, 'files.fid')
+            return 'SELECT fid FROM files WHERE NOT ' + cond_sql, params
+        raise TypeError('Invalid query node {!r}'.format(node))
+
+    def _and_order(self, node):
+        """Sort key for AND terms: positive terms by selectivity, then NOT."""
+        if isinstance(node, Not):
+            return (1, 0)
+        return (0, self.estimate(node))
+
+    def condition(self, node, column):
+        """Return SQL and parameters testing whether column matches."""
+        if isinstance(node, Tag):
+            alias = self._alias()
+            sql, params = _tag_where(node, alias)
+            return ('EXISTS (SELECT 1 FROM attributes AS {alias}'
+                    ' WHERE {alias}.fid={column} AND {where})').format(
+                        alias=alias, column=column, where=sql), params
+        elif isinstance(node, (And, Or)):
+            joiner = ' AND ' if isinstance(node, And) else ' OR '
+            terms = node.terms
+            if isinstance(node, And):
+                terms = sorted(terms, key=self._and_order)
+            parts = [self.condition(term, column) for term in terms]
+            return ('(' + joiner.join(sql for sql, _ in parts) + ')',
+                    [param for _, params in parts for param in params])
+        elif isinstance(node, Not):
+            sql, params = self.condition(node.term, column)
+            return 'NOT ' + sql, params
+        raise TypeError('Invalid query node {!r}'.format(node))
+
+
+def _tag_where(tag, alias=None):
+    """Return WHERE clause SQL and parameters matching a tag."""
+    prefix = alias + '.' if alias else ''
+    if tag.val is None:
+        return prefix + 'key=?', [tag.key]
+    return '{0}key=? AND {0}val=?'.format(prefix), [tag.key, tag.val]
+
+
+def _as_tree(query):
+    if isinstance(query, str):
+        return parse(query)
+    return query
+
+
+def search(backend, query, inodes=False):
+    """Yield fids of files matching a query.
+
+    Args:
+        backend: DbooruBackend instance.
+        query: Query text or query tree.
+        inodes: If true, yield pairs of fid and the file's ino column value
+            instead.
+
+    Results are streamed from the database as they are consumed.
+
+    """
+    sql, params = Planner(backend).select(_as_tree(query))
+    if inodes:
+        sql = ('SELECT q.fid, files.ino FROM ({}) AS q'
+               ' JOIN files ON files.fid=q.fid').format(sql)
+        yield from backend.conn.execute(sql, params)
+        return
+    cur = backend.conn.execute(sql, params)
+    for fid, in cur:
+        yield fid
+
+
+def count(backend, query):
+    """Return number of files matching a query."""
+    query = _as_tree(query)
+    if isinstance(query, Tag):
+        return backend.tag_count(query.key, query.val)
+    sql, params = Planner(backend).select(query)
+    return backend.conn.execute(
+        'SELECT COUNT(*) FROM ({})'.format(sql), params).fetchone()[0]
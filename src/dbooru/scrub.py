@@ -0,0 +1,366 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.scrub
+
+This module implements integrity checking and garbage collection.
+
+A scrub has two parts:
+
+- Reconciling: stored files are compared with the files table in bulk.
+  Records without a stored file are missing, and stored files without a
+  record are orphans.  Old temporary files in the staging directory are
+  garbage.
+- Verifying: stored files are rehashed in a worker pool, with reads rate
+  limited so a live instance stays responsive.  Files are verified in fid
+  order, and the last verified fid is saved to a checkpoint file, so an
+  interrupted scrub can be resumed.  Chunked files are reassembled from
+  their chunks, so missing or corrupt chunks are found too.
+
+Chunks not referenced by any manifest are also garbage, as chunks are not
+removed when their files are deleted.
+
+Problems are only repaired if requested.  Files younger than a grace period
+are never removed, as they may belong to an import or write in progress.
+
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+
+from dbooru.chunks import MANIFEST_SUFFIX
+from dbooru.ingest import bounded_map
+from dbooru.layout import stored_fid
+from dbooru.layout import walk_stored
+
+_CHUNK_LENGTH = 2 ** 20  # 1 MiB
+_RECONCILE_BATCH = 10000
+
+
+class RateLimiter:
+
+    """Token bucket limiting throughput across threads."""
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate: Units per second, or None for no limit.
+            burst: Maximum units available at once.  Defaults to rate.
+
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Wait until amount units are available and take them."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ScrubReport:
+
+    """Problems found by a scrub."""
+
+    def __init__(self):
+        self.verified = 0
+        self.bytes = 0
+        self.missing = []
+        self.orphans = []
+        self.corrupt = []
+        self.garbage = []
+        self.repaired = 0
+
+    def __repr__(self):
+        return ('{cls}(verified={verified}, bytes={bytes},'
+                ' missing={missing}, orphans={orphans}, corrupt={corrupt},'
+                ' garbage={garbage}, repaired={repaired})').format(
+                    cls=type(self).__name__, verified=self.verified,
+                    bytes=self.bytes, missing=len(self.missing),
+                    orphans=len(self.orphans), corrupt=len(self.corrupt),
+                    garbage=len(self.garbage), repaired=self.repaired)
+
+
+def _read_file(path):
+    """Yield the data of a file in blocks."""
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            data = file.read(_CHUNK_LENGTH)
+            if not data:
+                break
+            yield data
+
+
+def _hash_blocks(blocks, limiter):
+    """Return sha256 hex digest and size of data, reading at limited rate."""
+    hasher = hashlib.sha256()
+    size = 0
+    for data in blocks:
+        limiter.consume(len(data))
+        hasher.update(data)
+        size += len(data)
+    return hasher.hexdigest(), size
+
+
+class Scrubber:
+
+    """Integrity checker and garbage collector.
+
+    Example:
+
+        scrubber = Scrubber(backend, rate=100 * 2 ** 20,
+                            checkpoint='scrub.state')
+        report = scrubber.run()
+
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, backend, workers=None, rate=None, checkpoint=None,
+                 repair=False, grace=24 * 60 * 60, progress=None):
+        """
+        Args:
+            backend: DbooruBackend instance.
+            workers: Number of hashing workers.  Defaults to the CPU count.
+            rate: Maximum bytes read per second, or None for no limit.
+            checkpoint: Path to a file recording verification progress.  If
+                the file exists, verification resumes after the recorded fid.
+            repair: Repair problems found.  Missing records are deleted,
+                orphans and garbage are removed, and corrupt files are moved
+                to the quarantine directory.
+            grace: Seconds since last change before an orphan or temporary
+                file may be removed.
+            progress: Callable called with the ScrubReport periodically.
+
+        """
+        self._backend = backend
+        self._workers = workers or os.cpu_count() or 1
+        self._limiter = RateLimiter(rate)
+        self._checkpoint = checkpoint
+        self._repair = repair
+        self._grace = grace
+        self._progress = progress
+        self.report = ScrubReport()
+
+    @property
+    def quarantine_dir(self):
+        """Directory corrupt files are moved to when repairing."""
+        return os.path.join(self._backend.root, 'quarantine')
+
+    def run(self, reconcile=True, verify=True):
+        """Run a scrub and return its ScrubReport."""
+        if reconcile:
+            self.reconcile()
+            self.collect_garbage()
+            self.collect_chunks()
+        if verify:
+            self.verify()
+        return self.report
+
+    def _is_old(self, path):
+        try:
+            return os.lstat(path).st_ctime < time.time() - self._grace
+        except FileNotFoundError:
+            return False
+
+    def reconcile(self):
+        """Compare stored files with the files table."""
+        conn = self._backend.conn
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS scrub_stored'
+                     ' (fid text PRIMARY KEY, path text)')
+        conn.execute('DELETE FROM scrub_stored')
+        # Files being added or deleted have markers in staging; leave them
+        # for DbooruBackend.recover().
+        pending = set(name.partition('.')[0]
+                      for name in os.listdir(self._backend.staging_dir))
+        batch = []
+        for entry in walk_stored(self._backend.files_dir):
+            batch.append((stored_fid(entry.name), entry.path))
+            if len(batch) >= _RECONCILE_BATCH:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO scrub_stored VALUES (?, ?)', batch)
+                batch = []
+        conn.executemany(
+            'INSERT OR IGNORE INTO scrub_stored VALUES (?, ?)', batch)
+        # Files stored since they were walked are rechecked.
+        missing = [fid for fid, in conn.execute(
+            '''SELECT fid FROM files WHERE NOT EXISTS
+            (SELECT 1 FROM scrub_stored WHERE scrub_stored.fid=files.fid)''')
+                   if fid not in pending and not self._backend.exists(fid)]
+        orphans = [(fid, path) for fid, path in conn.execute(
+            '''SELECT fid, path FROM scrub_stored WHERE NOT EXISTS
+            (SELECT 1 FROM files WHERE files.fid=scrub_stored.fid)''')
+                   if fid not in pending]
+        conn.execute('DROP TABLE scrub_stored')
+        self.report.missing.extend(missing)
+        self.report.orphans.extend(fid for fid, _ in orphans)
+        if not self._repair:
+            return
+        if missing:
+            with self._backend.transaction() as conn:
+                conn.executemany('DELETE FROM files WHERE fid=?',
+                                 [(fid,) for fid in missing])
+            for fid in missing:
+                self._backend.journal.invalidate(fid)
+            self._backend.changed()
+            self.report.repaired += len(missing)
+        for fid, path in orphans:
+            if self._is_old(path):
+                os.unlink(path)
+                self._backend.attr_cache.pop(fid)
+                self.report.repaired += 1
+
+    def collect_garbage(self):
+        """Find temporary files left in staging by interrupted writes."""
+        staging_dir = self._backend.staging_dir
+        for name in os.listdir(staging_dir):
+            if not name.startswith('tmp'):
+                continue
+            path = os.path.join(staging_dir, name)
+            if not self._is_old(path):
+                continue
+            self.report.garbage.append(name)
+            if self._repair:
+                os.unlink(path)
+                self.report.repaired += 1
+
+    def collect_chunks(self):
+        """Find chunks not referenced by any chunked file."""
+        chunk_store = self._backend.chunk_store
+        if not os.path.isdir(chunk_store.chunks_dir):
+            return
+        referenced = set()
+        for entry in walk_stored(self._backend.files_dir):
+            if entry.name != stored_fid(entry.name):
+                try:
+                    manifest = chunk_store.manifest(entry.path)
+                except FileNotFoundError:
+                    continue
+                referenced.update(manifest.hashes)
+        for shard in os.scandir(chunk_store.chunks_dir):
+            for entry in os.scandir(shard.path):
+                if entry.name in referenced or not self._is_old(entry.path):
+                    continue
+                self.report.garbage.append(entry.name)
+                if self._repair:
+                    os.unlink(entry.path)
+                    self.report.repaired += 1
+
+    def _load_checkpoint(self):
+        if self._checkpoint is None:
+            return ''
+        try:
+            with open(self._checkpoint) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return ''
+
+    def _save_checkpoint(self, fid):
+        if self._checkpoint is None:
+            return
+        tmp_path = self._checkpoint + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(fid + '\n')
+        os.replace(tmp_path, self._checkpoint)
+
+    def _recorded_fids(self, after):
+        """Yield recorded fids greater than after, in order."""
+        conn = self._backend.conn
+        while True:
+            rows = conn.execute(
+                'SELECT fid FROM files WHERE fid>? ORDER BY fid LIMIT ?',
+                (after, _RECONCILE_BATCH)).fetchall()
+            if not rows:
+                return
+            for fid, in rows:
+                yield fid
+            after = rows[-1][0]
+
+    def _check(self, fid):
+        """Return (fid, actual hash, size), or (fid, None, 0) if missing."""
+        backend = self._backend
+        try:
+            digest, size = _hash_blocks(_read_file(backend.fid_path(fid)),
+                                        self._limiter)
+        except FileNotFoundError:
+            pass
+        else:
+            return fid, digest, size
+        try:
+            manifest = backend.chunk_store.manifest(backend.manifest_path(fid))
+        except FileNotFoundError:
+            return fid, None, 0
+        try:
+            digest, size = _hash_blocks(
+                backend.chunk_store.iter_data(manifest), self._limiter)
+        except FileNotFoundError:
+            # Missing chunk.
+            return fid, '', manifest.size
+        return fid, digest, size
+
+    def verify(self):
+        """Rehash recorded files and check they match their fids."""
+        report = self.report
+        start = self._load_checkpoint()
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as executor:
+            results = bounded_map(executor, self._check,
+                                  self._recorded_fids(start),
+                                  self._workers * 4)
+            for fid, digest, size in results:
+                if digest is not None and digest != fid:
+                    report.corrupt.append(fid)
+                    if self._repair:
+                        self._quarantine(fid)
+                report.verified += 1
+                report.bytes += size
+                if report.verified % 1000 == 0:
+                    self._save_checkpoint(fid)
+                    if self._progress is not None:
+                        self._progress(report)
+        if self._checkpoint is not None:
+            # Finished, so the next scrub starts over.
+            try:
+                os.unlink(self._checkpoint)
+            except FileNotFoundError:
+                pass
+        if self._progress is not None:
+            self._progress(report)
+
+    def _quarantine(self, fid):
+        """Move a corrupt file out of storage."""
+        os.makedirs(self.quarantine_dir, exist_ok=True)
+        name = fid
+        if self._backend.is_chunked(fid):
+            name += MANIFEST_SUFFIX
+        os.rename(self._backend.fid_path(name),
+                  os.path.join(self.quarantine_dir, name))
+        self._backend.attr_cache.pop(fid)
+        self.report.repaired += 1
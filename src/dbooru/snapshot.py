@@ -0,0 +1,176 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.snapshot
+
+This module implements index snapshots.
+
+An index snapshot is a compact copy of the recorded fids with their inode
+numbers and of the attribute keys, written when unmounting so that the next
+mount can answer lookups immediately while it reads the database in the
+background.  Snapshots are memory mapped and searched in place, so opening
+one takes constant time.
+
+The file starts with a header (see _HEADER), followed by fid records sorted
+by fid, each the 32 byte binary fid and its ino column value, then the byte
+offsets of the keys in the key data, with a final offset marking its end,
+then the key data: the UTF-8 encoded keys, sorted.  Integers are little
+endian.  The header records the database serials the snapshot is current
+for; see DbooruBackend.open_snapshot().
+
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+_MAGIC = b'DBIX'
+_VERSION = 1
+# magic, version, generation, files sequence, file deletes, key serial,
+# fid count, key count
+_HEADER = struct.Struct('<4sI6Q')
+_FID = struct.Struct('<32sQ')
+_OFFSET = struct.Struct('<Q')
+
+
+class SnapshotError(Exception):
+    """Invalid index snapshot."""
+
+
+def write_snapshot(path, conn, serials):
+    """Write an index snapshot atomically.
+
+    Args:
+        path: Path of the snapshot file.
+        conn: Database connection, which should be in a read transaction so
+            the snapshot is consistent with serials.
+        serials: Tuple of generation, files sequence, file deletes and key
+            serial the snapshot is current for.
+
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with open(fd, 'wb') as file:
+            file.write(_HEADER.pack(_MAGIC, _VERSION, *serials, 0, 0))
+            fid_count = 0
+            for fid, ino in conn.execute(
+                    'SELECT fid, ino FROM files ORDER BY fid'):
+                file.write(_FID.pack(bytes.fromhex(fid), ino))
+                fid_count += 1
+            # SQLite sorts text by its UTF-8 bytes, as is required here.
+            keys = [key.encode() for key, in conn.execute(
+                'SELECT key FROM tag_keys ORDER BY key')]
+            offset = 0
+            for key in keys:
+                file.write(_OFFSET.pack(offset))
+                offset += len(key)
+            file.write(_OFFSET.pack(offset))
+            file.writelines(keys)
+            file.seek(0)
+            file.write(_HEADER.pack(_MAGIC, _VERSION, *serials,
+                                    fid_count, len(keys)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class IndexSnapshot:
+
+    """Memory mapped index snapshot.  See write_snapshot()."""
+
+    def __init__(self, path):
+        """
+        Raises:
+            FileNotFoundError: There is no snapshot.
+            SnapshotError: The snapshot is invalid or of another version.
+
+        """
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < _HEADER.size:
+                raise SnapshotError('Truncated snapshot')
+            self._map = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        (magic, version, self.generation, self.files_seq, self.file_deletes,
+         self.key_serial, self._fid_count,
+         self._key_count) = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise SnapshotError('Not a version {} snapshot'.format(_VERSION))
+        self._fids_start = _HEADER.size
+        self._offsets_start = self._fids_start + self._fid_count * _FID.size
+        self._keys_start = (self._offsets_start
+                            + (self._key_count + 1) * _OFFSET.size)
+        if self._keys_start > size:
+            self.close()
+            raise SnapshotError('Truncated snapshot')
+
+    @property
+    def serials(self):
+        """Tuple of the serials the snapshot is current for."""
+        return (self.generation, self.files_seq, self.file_deletes,
+                self.key_serial)
+
+    def close(self):
+        """Unmap the snapshot."""
+        self._map.close()
+
+    def inode(self, fid):
+        """Return the ino column value of a fid, or None if not present."""
+        try:
+            key = bytes.fromhex(fid)
+        except ValueError:
+            return None
+        data = self._map
+        start = self._fids_start
+        record = _FID.size
+        low, high = 0, self._fid_count
+        while low < high:
+            middle = (low + high) // 2
+            pos = start + middle * record
+            current = data[pos:pos + 32]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return _FID.unpack_from(data, pos)[1]
+        return None
+
+    def _key(self, index):
+        pos = self._offsets_start + index * _OFFSET.size
+        start, end = struct.unpack_from('<2Q', self._map, pos)
+        return self._map[self._keys_start + start:self._keys_start + end]
+
+    def has_key(self, key):
+        """Return whether the snapshot contains an attribute key."""
+        key = key.encode()
+        low, high = 0, self._key_count
+        while low < high:
+            middle = (low + high) // 2
+            current = self._key(middle)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return True
+        return False
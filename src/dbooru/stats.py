@@ -0,0 +1,184 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.stats
+
+This module implements operation counters and latency histograms.
+
+Latencies are counted in power of two buckets of microseconds, so recording
+is a few arithmetic operations and a histogram takes constant memory.
+
+"""
+
+import contextlib
+import functools
+import threading
+import time
+
+# Bucket i counts latencies in [2 ** (i - 1), 2 ** i) microseconds; bucket 0
+# counts latencies under one microsecond.  The last bucket is unbounded.
+_BUCKETS = 32
+
+
+class Histogram:
+
+    """Latency histogram with power of two buckets.
+
+    Not thread safe by itself; Stats serializes updates.
+
+    """
+
+    __slots__ = ('count', 'errors', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * _BUCKETS
+
+    def add(self, seconds):
+        """Record a latency."""
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[min(bucket, _BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """Return upper bound in seconds of the given latency percentile."""
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min((2 ** bucket) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        """Return histogram as a JSON serializable dict."""
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            # Maps bucket upper bound in microseconds to count.
+            'buckets': {str(2 ** bucket): count
+                        for bucket, count in enumerate(self.buckets)
+                        if count},
+        }
+
+
+class Stats:
+
+    """Collection of named latency histograms.
+
+    Example:
+
+        with stats.timer('lookup'):
+            ...
+
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, error=False):
+        """Record latency of an operation."""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+            if error:
+                histogram.errors += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Context manager recording latency of its body."""
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start, error)
+
+    def clear(self):
+        """Remove all histograms."""
+        with self._lock:
+            self._histograms.clear()
+
+    def to_dict(self):
+        """Return dict mapping names to histogram dicts."""
+        with self._lock:
+            return {name: histogram.to_dict()
+                    for name, histogram in sorted(self._histograms.items())}
+
+
+def timed(method):
+    """Decorator recording latency of a method in self.stats.
+
+    The method's name is used as the histogram name.  If the method returns
+    a generator, the time spent iterating it is recorded instead.
+
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            self.stats.record(name, time.perf_counter() - start, True)
+            raise
+        if hasattr(result, 'send'):
+            return _timed_iter(self.stats, name, result,
+                               time.perf_counter() - start)
+        self.stats.record(name, time.perf_counter() - start)
+        return result
+    return wrapper
+
+
+def _timed_iter(stats, name, iterator, elapsed):
+    """Yield from iterator, recording time spent in it plus elapsed."""
+    error = False
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            except BaseException:
+                error = True
+                elapsed += time.perf_counter() - start
+                raise
+            elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        stats.record(name, elapsed, error)
@@ -0,0 +1,165 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""dbooru.tables
+
+This module implements the file handle and inode tables used by FUSEOp.
+
+All operations on both tables are O(1) and thread safe, and reference counts
+are updated in place.
+
+"""
+
+from array import array
+import sys
+import threading
+
+
+class HandleTable:
+
+    """File handle table.
+
+    Handlers are stored in a list indexed by file handle, with reference
+    counts in a parallel array.  Released handles are kept on a free list
+    stack and reused before the table grows.
+
+    """
+
+    FIRST = 3
+
+    def __init__(self):
+        self._handlers = []
+        self._counts = array('l')
+        self._free = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handlers) - len(self._free)
+
+    def _index(self, fh):
+        index = fh - self.FIRST
+        if (index < 0 or index >= len(self._handlers)
+                or self._handlers[index] is None):
+            raise KeyError(fh)
+        return index
+
+    def add(self, handler):
+        """Add handler with a reference count of one and return its handle."""
+        with self._lock:
+            if self._free:
+                index = self._free.pop()
+                self._handlers[index] = handler
+                self._counts[index] = 1
+            else:
+                index = len(self._handlers)
+                self._handlers.append(handler)
+                self._counts.append(1)
+        return index + self.FIRST
+
+    def __getitem__(self, fh):
+        return self._handlers[self._index(fh)]
+
+    def decref(self, fh, count=1):
+        """Decrement reference count of handle and return the new count."""
+        with self._lock:
+            index = self._index(fh)
+            self._counts[index] -= count
+            return self._counts[index]
+
+    def remove(self, fh):
+        """Remove handle from the table so it can be reused."""
+        with self._lock:
+            index = self._index(fh)
+            self._handlers[index] = None
+            self._counts[index] = 0
+            self._free.append(index)
+
+    def stats(self):
+        """Return dict of table statistics."""
+        return {
+            'live': len(self),
+            'capacity': len(self._handlers),
+            'free': len(self._free),
+            'bytes': (sys.getsizeof(self._handlers)
+                      + sys.getsizeof(self._counts)
+                      + sys.getsizeof(self._free)),
+        }
+
+
+class _InodeEntry:
+
+    """Inode table entry."""
+
+    __slots__ = ('handler', 'count')
+
+    def __init__(self, handler, count):
+        self.handler = handler
+        self.count = count
+
+
+class InodeTable:
+
+    """Inode table mapping inode numbers to handlers and lookup counts."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, inode):
+        return inode in self._entries
+
+    def __getitem__(self, inode):
+        return self._entries[inode].handler
+
+    def incref(self, handler, count=1):
+        """Increment lookup count of the handler's inode.
+
+        The handler is added to the table if its inode isn't present.
+
+        """
+        inode = handler.attr.st_ino
+        with self._lock:
+            entry = self._entries.get(inode)
+            if entry is None:
+                self._entries[inode] = _InodeEntry(handler, count)
+            else:
+                entry.count += count
+
+    def decref(self, inode, count=1):
+        """Decrement lookup count, removing the inode when it reaches zero.
+
+        Returns the new count.
+
+        """
+        with self._lock:
+            entry = self._entries[inode]
+            entry.count -= count
+            if entry.count < 1:
+                del self._entries[inode]
+            return entry.count
+
+    def stats(self):
+        """Return dict of table statistics."""
+        return {
+            'live': len(self._entries),
+            'bytes': (sys.getsizeof(self._entries)
+                      + len(self._entries) * sys.getsizeof(
+                          _InodeEntry(None, 0))),
+        }
@@ -0,0 +1,67 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for bulk importing."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from dbooru import ingest
+from dbooru.backend import DbooruBackend
+
+
+class ImporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = DbooruBackend(os.path.join(self.root, 'dbooru'))
+        self.backend.init()
+        self.src = os.path.join(self.root, 'src')
+        os.mkdir(self.src)
+        self.checkpoint = os.path.join(self.root, 'import.log')
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.root)
+
+    def _make_files(self, *names):
+        paths = []
+        for name in names:
+            path = os.path.join(self.src, name)
+            with open(path, 'w') as file:
+                file.write(name)
+            paths.append(path)
+        return paths
+
+    def test_vanished_file(self):
+        paths = self._make_files('a', 'b', 'c')
+        # Found by the scan, but gone before it is read.
+        missing = os.path.join(self.src, 'missing')
+        importer = ingest.Importer(self.backend, workers=2, batch_size=2,
+                                   checkpoint=self.checkpoint)
+        with mock.patch.object(ingest, 'walk_files',
+                               return_value=[paths[0], missing] + paths[1:]):
+            stats = importer.run([self.src])
+        self.assertEqual(stats.files, 3)
+        self.assertEqual(stats.stored, 3)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(self.backend.file_count(), 3)
+        with open(self.checkpoint) as file:
+            self.assertEqual(sorted(file.read().split()), paths)
@@ -0,0 +1,61 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for upgrading instances made by old versions."""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from dbooru.backend import DbooruBackend
+
+
+class MigrateFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # Schema of instances from before files had inode numbers.
+        conn = sqlite3.connect(os.path.join(self.root, 'dbooru.db'))
+        conn.execute('CREATE TABLE files (fid text)')
+        conn.execute(
+            '''CREATE TABLE attributes (fid text, key text, val text,
+            PRIMARY KEY (fid, key) ON CONFLICT REPLACE)''')
+        conn.executemany('INSERT INTO files VALUES (?)',
+                         [('a',), ('b',), ('a',), ('c',), ('b',)])
+        conn.executemany('INSERT INTO attributes VALUES (?, ?, ?)',
+                         [('a', 'k', 'v'), ('b', 'k', 'w'), ('c', 'j', 'v')])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_duplicate_fids(self):
+        backend = DbooruBackend(self.root)
+        try:
+            backend.init()
+            rows = backend.conn.execute(
+                'SELECT fid, ino FROM files ORDER BY ino').fetchall()
+            self.assertEqual([fid for fid, _ in rows], ['a', 'b', 'c'])
+            self.assertEqual(backend.file_count(), 3)
+            self.assertEqual(backend.get_attrs('a'), {'k': 'v'})
+            self.assertEqual(backend.tag_count('k'), 2)
+            self.assertEqual(backend.inode('c'), rows[2][1])
+        finally:
+            backend.close()
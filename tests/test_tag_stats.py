@@ -0,0 +1,133 @@
+# Copyright (C) 2015  Allen Li
+#
+# This file is part of dbooru.
+#
+# dbooru is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# dbooru is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with dbooru.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the tag counts maintained by database triggers."""
+
+import shutil
+import tempfile
+import unittest
+
+from dbooru.backend import DbooruBackend
+from dbooru.ingest import record_files
+
+
+class TagCountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = DbooruBackend(self.root)
+        self.backend.init()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.root)
+
+    def test_record_files(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b', 'c'], {'k': 'v', 'j': 'w'})
+        record_files(backend, ['d'], {'k': 'v'})
+        self.assertEqual(backend.tag_count('k'), 4)
+        self.assertEqual(backend.tag_count('k', 'v'), 4)
+        self.assertEqual(backend.tag_count('j', 'w'), 3)
+        self.assertEqual(backend.tag_key_count(), 2)
+
+    def test_record_files_again(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b'], {'k': 'v'})
+        record_files(backend, ['a', 'b'], {'k': 'v'})
+        record_files(backend, ['a'], {'k': 'x'})
+        self.assertEqual(backend.tag_count('k'), 2)
+        self.assertEqual(backend.tag_count('k', 'v'), 1)
+        self.assertEqual(backend.tag_count('k', 'x'), 1)
+
+    def test_journal(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b', 'c'], {})
+        for fid in ('a', 'b', 'c'):
+            backend.journal.set_attr(fid, 'k', 'v')
+        backend.journal.set_attr('c', 'j', 'w')
+        backend.journal.flush()
+        self.assertEqual(backend.tag_count('k'), 3)
+        self.assertEqual(backend.tag_count('k', 'v'), 3)
+        self.assertEqual(backend.tag_count('j'), 1)
+
+    def test_journal_and_record_files(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b'], {'k': 'v'})
+        backend.journal.set_attr('a', 'k', 'x')
+        backend.journal.set_attr('b', 'j', 'w')
+        backend.journal.flush()
+        record_files(backend, ['c'], {'k': 'v', 'j': 'w'})
+        self.assertEqual(backend.tag_count('k'), 3)
+        self.assertEqual(backend.tag_count('k', 'v'), 2)
+        self.assertEqual(backend.tag_count('k', 'x'), 1)
+        self.assertEqual(backend.tag_count('j'), 2)
+
+    def test_conflict_clause(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b'], {'k': 'v'})
+        with backend.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO attributes VALUES ('b', 'j', 'w')")
+            conn.execute(
+                "INSERT OR REPLACE INTO attributes VALUES ('a', 'k', 'v')")
+        backend.changed()
+        self.assertEqual(backend.tag_count('k'), 2)
+        self.assertEqual(backend.tag_count('k', 'v'), 2)
+        self.assertEqual(backend.tag_count('j'), 1)
+
+
+class TagPairCountTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = DbooruBackend(self.root)
+        self.backend.init()
+        self.backend.refresh_tag_pairs(10)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.root)
+
+    def test_record_files(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b', 'c'], {'k': 'v', 'j': 'w'})
+        record_files(backend, ['a', 'd'], {'k': 'v', 'j': 'w'})
+        self.assertEqual(backend.tag_pair_count('j', 'k'), 4)
+
+    def test_journal(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b'], {'k': 'v'})
+        backend.journal.set_attr('a', 'j', 'w')
+        backend.journal.set_attr('b', 'j', 'w')
+        backend.journal.flush()
+        backend.journal.delete_attr('b', 'k')
+        backend.journal.flush()
+        self.assertEqual(backend.tag_pair_count('j', 'k'), 1)
+
+    def test_conflict_clause(self):
+        backend = self.backend
+        record_files(backend, ['a', 'b', 'c'], {'k': 'v', 'j': 'w'})
+        with backend.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO attributes VALUES ('c', 'k', 'x')")
+            conn.execute(
+                "INSERT OR REPLACE INTO attributes VALUES ('a', 'i', 'u')")
+        backend.changed()
+        self.assertEqual(backend.tag_pair_count('j', 'k'), 3)
+        self.assertEqual(backend.tag_pair_count('i', 'k'), 1)
+        self.assertEqual(backend.tag_pair_count('i', 'j'), 1)